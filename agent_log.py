@@ -0,0 +1,97 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+
+from artifacts import write_artifact_async
+
+# LogRecord attributes that are not user-supplied structured fields
+RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+dump_settings = {
+    'dir': None,
+    'rate': 1.0,
+    'max_bytes': 1048576,
+}
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line; fields passed through `extra=` become top-level keys
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RESERVED_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level="INFO", log_file=None, dump_dir=None, dump_rate=1.0, dump_max_bytes=1048576):
+    # Records are queued by the calling thread; formatting and I/O happen on the listener thread
+    global _listener
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.handlers.WatchedFileHandler(log_file))
+    formatter = JsonFormatter()
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(-1)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+    if _listener is not None:
+        _listener.stop()
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+    dump_settings['dir'] = dump_dir
+    dump_settings['rate'] = dump_rate
+    dump_settings['max_bytes'] = dump_max_bytes
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def truncate_payload(payload, max_bytes):
+    text = payload if isinstance(payload, str) else json.dumps(payload, separators=(',', ':'), default=str)
+    if len(text) > max_bytes:
+        return text[:max_bytes] + f"...[{len(text) - max_bytes} chars truncated]"
+    return text
+
+
+def debug_payload(logger, message, payload, **fields):
+    # Large payloads are only serialised when debug logging is actually enabled
+    if logger.isEnabledFor(logging.DEBUG):
+        fields['payload'] = truncate_payload(payload, dump_settings['max_bytes'])
+        logger.debug(message, extra=fields)
+
+
+def debug_dump(logger, name, payload):
+    # Sampled, size-capped copy of a payload on disk, written by the background artifact writer
+    if not dump_settings['dir'] or not logger.isEnabledFor(logging.DEBUG):
+        return
+    if random.random() >= dump_settings['rate']:
+        return
+    os.makedirs(dump_settings['dir'], exist_ok=True)
+    path = os.path.join(dump_settings['dir'], f"{name}_{time.strftime('%Y%m%d_%H%M%S')}_{random.getrandbits(32):08x}.json")
+    write_artifact_async({'name': name, 'payload': truncate_payload(payload, dump_settings['max_bytes'])}, path)
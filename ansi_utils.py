@@ -1,60 +1,189 @@
 import os
 import json
+import logging
 import ansible_runner
 import subprocess
-import sys
-import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from inventory import load_inventory
+from workspace import run_workspace
+from metrics import timed
+from ansible_env import get_ansible_envvars, get_fact_cache_settings, get_forks
+
+logger = logging.getLogger(__name__)
 
 config = {}
 headers = {}
 
 
-def get_host_res(runner):
-    # Initialize a dictionary to hold results for each host
-    host_results = {}
-
-    # Process the detailed events for task-level output
-    for event in runner.events:
+TERMINAL_EVENTS = ('runner_on_ok', 'runner_on_failed', 'runner_on_unreachable')
+FAILED_EVENTS = ('runner_on_failed', 'runner_on_unreachable')
+STATS_CATEGORIES = ('ok', 'failures', 'dark', 'skipped', 'ignored', 'rescued', 'processed', 'changed')
+
+
+class HostResultAggregator:
+    # Builds per-host results from ansible-runner events as they arrive. Modes:
+    #   compact  - rc, final output, script_output and capped stdout per host; verbose task
+    #              records are streamed to a JSON-lines file instead of being kept in memory
+    #   summary  - only the last ok/failed/unreachable result per host, completed from the play stats
+    #   detailed - compact plus the full per-task history of every host in memory
+    # Every mode decides a host's return code the same way, see host_return_code().
+
+    def __init__(self, max_host_stdout=65536, event_log_path=None, mode='compact'):
+        self.max_host_stdout = max_host_stdout
+        self.event_log_path = event_log_path if mode == 'compact' else None
+        self.event_log = None
+        self.mode = mode
+        self.host_results = {}
+        self.stats = None
+        # host -> rc of its last failed or unreachable result (None when the result had no rc)
+        self.failed_hosts = {}
+
+    def get_host(self, host):
+        details = self.host_results.get(host)
+        if details is None:
+            details = {'finalout': '', 'script_output': [], 'return_code': None}
+            if self.mode != 'summary':
+                details['stdout'] = ''
+                details['task_count'] = 0
+            if self.mode == 'detailed':
+                details['tasks'] = []
+            self.host_results[host] = details
+        return details
+
+    def _record_failure(self, event, event_data):
+        # Failures under ignore_errors do not fail the host
+        if event.get('event') == 'runner_on_failed' and event_data.get('ignore_errors'):
+            return
+        res = event_data.get('res') or {}
+        self.failed_hosts[event_data.get('host')] = res.get('rc') or None
+
+    def _append_stdout(self, details, stdout):
+        remaining = self.max_host_stdout - len(details['stdout'])
+        if stdout and remaining > 0:
+            details['stdout'] += stdout[:remaining] + '\n'
+
+    def _log_event(self, host, event, event_data):
+        if not self.event_log_path:
+            return
+        if self.event_log is None:
+            os.makedirs(os.path.dirname(self.event_log_path), exist_ok=True)
+            self.event_log = open(self.event_log_path, 'a')
+        record = {
+            'host': host,
+            'task': event_data.get('task', 'N/A'),
+            'status': event.get('event', 'N/A'),
+            'stdout': event.get('stdout', ''),
+            'result': event_data.get('res', {}),
+        }
+        self.event_log.write(json.dumps(record, separators=(',', ':'), default=str) + '\n')
+
+    def _summary_event(self, host, event, event_data):
+        # Only terminal task results matter; everything else is skipped without building state
+        event_type = event.get('event')
+        if event_type not in TERMINAL_EVENTS:
+            return
+        details = self.get_host(host)
+        if event_type == 'runner_on_ok':
+            res = event_data.get('res') or {}
+            output = res.get('script_output')
+            if output is not None:
+                details['script_output'].append(output)
+            details['finalout'] = res
+
+    def event_handler(self, event):
         event_data = event.get('event_data', {})
         host = event_data.get('host')
-        if host:
-            task = event_data.get('task', 'N/A')
-            result = event_data.get('res', {})
-            status = event.get('event', 'N/A')
-            stdout = event_data.get('stdout', '')
-
-            if host not in host_results:
-                host_results[host] = {
-                    'tasks': [],
-                    'finalout': '',
-                    'script_output': [],
-                    'return_code': event_data.get('rc', runner.rc),
-                }
+        if event.get('event') == 'playbook_on_stats':
+            # Kept here because runner.stats reads job_events, which this handler keeps empty
+            self.stats = {category: event_data.get(category) or {} for category in STATS_CATEGORIES}
+        if host and event.get('event') in FAILED_EVENTS:
+            self._record_failure(event, event_data)
+        if host and self.mode == 'summary':
+            self._summary_event(host, event, event_data)
+        elif host:
+            details = self.get_host(host)
+            details['task_count'] += 1
+            self._append_stdout(details, event.get('stdout', ''))
+
+            if event.get('event') == 'runner_on_ok':
+                res = event_data.get('res') or {}
+                output = res.get('script_output')
+                if output is not None:
+                    details['script_output'].append(output)
+                details['finalout'] = res
+
+            if self.mode == 'detailed':
+                details['tasks'].append({
+                    'task': event_data.get('task', 'N/A'),
+                    'status': event.get('event', 'N/A'),
+                    'stdout': event_data.get('stdout', ''),
+                    'result': event_data.get('res', {}),
+                })
+            self._log_event(host, event, event_data)
+        # Events are summarised here, so ansible-runner does not need to keep them on disk
+        return False
+
+    def close(self):
+        if self.event_log is not None:
+            self.event_log.close()
+            self.event_log = None
+
+
+def read_runner_stdout(runner, max_bytes):
+    # Only keep the tail of the runner stdout rather than reading the whole file
+    stdout_path = os.path.join(runner.config.artifact_dir, 'stdout')
+    if not os.path.exists(stdout_path):
+        return ''
+    with open(stdout_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - max_bytes))
+        return f.read().decode('utf-8', errors='replace')
+
+
+def get_host_stats(stats):
+    # Play stats are keyed by category ('ok', 'failures', 'dark', ...); index them by host instead
+    host_stats = {}
+    for category, hosts in (stats or {}).items():
+        if isinstance(hosts, dict):
+            for host, count in hosts.items():
+                host_stats.setdefault(host, {})[category] = count
+    return host_stats
+
+
+def host_return_code(host, aggregator, host_stats, runner):
+    # Once the play stats arrive they decide (failures and unreachable count, rescued and ignored
+    # errors do not); without them the failed/unreachable results seen for the host decide.
+    # A failed host keeps the rc of its failing result when it had one.
+    if aggregator.stats is not None:
+        stats = host_stats.get(host, {})
+        failed = bool(stats.get('failures') or stats.get('dark'))
+    else:
+        failed = host in aggregator.failed_hosts
+    if failed:
+        return aggregator.failed_hosts.get(host) or runner.rc or 1
+    if aggregator.stats is None:
+        # The play did not finish, so a host without a failure has not necessarily succeeded
+        return runner.rc
+    return 0
+
+
+def get_host_res(runner, aggregator):
+    aggregator.close()
+    host_results = aggregator.host_results
+    host_stats = get_host_stats(aggregator.stats)
+
+    # Hosts that only show up in the stats (e.g. every task skipped in summary mode) still get a row
+    for host in host_stats:
+        aggregator.get_host(host)
+    for host, details in host_results.items():
+        details['return_code'] = host_return_code(host, aggregator, host_stats, runner)
 
-            if event['event'] == 'runner_on_ok':
-                if 'script_output' in event['event_data']['res']:
-                    output = event['event_data']['res']['script_output']
-                    if output is not None:
-                        host_results[host]['script_output'].append(output)
-
-                if 'res' in event['event_data']:
-                    rcP = event['event_data'].get('res')
-                    if 'rc' in rcP:
-                        host_results[host]['return_code'] = rcP.get('rc')
-                    finalout = event['event_data']['res']
-                    host_results[host]['finalout'] = finalout
-
-            host_results[host]['tasks'].append({
-                'task': task,
-                'status': status,
-                'stdout': stdout,
-                'result': result,
-            })
-
-    if runner.stats is not None:
-        for host, stats in runner.stats.get('hosts', {}).items():
-            if host in host_results:
-                host_results[host]['stats'] = stats
+    for host, stats in host_stats.items():
+        if host in host_results:
+            host_results[host]['stats'] = stats
 
     transformed_results = []
     for host, details in host_results.items():
@@ -64,34 +193,137 @@ def get_host_res(runner):
         }
         transformed_results.append(res1)
     final_result = {
-        "stdout": runner.stdout.read(),
+        "stdout": read_runner_stdout(runner, int(config.get("max_runner_stdout", 1048576))),
         'output': transformed_results
     }
     return final_result
 
 
-def run_ansible_playbook(playbook, inventory, extra_vars=None):
-    print("Running Playbook")
-    # Get the private data directory (where ansible-runner will store its data)
-    private_data_dir = os.path.join(os.getcwd(), '.ansible-runner')
+def get_workspace_root():
+    return config.get("runner_workspace_root") or os.path.join(os.getcwd(), '.ansible-runner')
+
+
+def run_playbook_once(playbook, inventory, extra_vars, progress, private_data_dir, limit=None):
     os.makedirs(private_data_dir, exist_ok=True)
 
-    runner = ansible_runner.run(
-        private_data_dir=private_data_dir,
-        playbook=playbook,
-        inventory=inventory,
-        extravars=extra_vars,
-        json_mode=True,
-        quiet=True,
-        debug=False
+    # Verbose events are only written when event_log_dir names a directory that outlives the run;
+    # it is bounded by artifact eviction like the other agent artifacts
+    event_log_dir = config.get("event_log_dir")
+    aggregator = HostResultAggregator(
+        max_host_stdout=int(config.get("max_host_stdout", 65536)),
+        event_log_path=os.path.join(event_log_dir, f"{uuid.uuid4()}.jsonl") if event_log_dir else None,
+        mode=config.get("result_mode", "compact"),
     )
-    print(f"Runner  res - {runner} {playbook} {inventory} ")
-    return get_host_res(runner)
+
+    def event_handler(event):
+        if progress is not None:
+            progress.event_handler(event)
+        return aggregator.event_handler(event)
+
+    try:
+        with timed("ansible_run"):
+            runner = ansible_runner.run(
+                private_data_dir=private_data_dir,
+                playbook=playbook,
+                inventory=inventory,
+                limit=limit,
+                extravars=extra_vars,
+                envvars=get_ansible_envvars(config),
+                forks=get_forks(config),
+                **get_fact_cache_settings(config),
+                event_handler=event_handler,
+                status_handler=progress.status_handler if progress is not None else None,
+                json_mode=True,
+                quiet=True,
+                debug=False
+            )
+    finally:
+        aggregator.close()
+    logger.info("Runner finished", extra={'status': runner.status, 'rc': runner.rc, 'playbook': playbook,
+                                          'inventory': inventory, 'limit': limit})
+    with timed("host_results"):
+        return get_host_res(runner, aggregator)
+
+
+def failed_shard_result(hosts, error):
+    # Hosts of a shard whose runner could not complete are reported as failed
+    return {
+        'stdout': f"Shard failed: {error}",
+        'output': [
+            {
+                'hostId': host,
+                'hostDetails': {
+                    'finalout': f"Shard failed: {error}",
+                    'script_output': [],
+                    'return_code': -1,
+                    'stdout': '',
+                    'task_count': 0,
+                }
+            }
+            for host in hosts
+        ]
+    }
+
+
+def merge_shard_results(shard_results):
+    max_stdout = int(config.get("max_runner_stdout", 1048576))
+    output = []
+    stdout_parts = []
+    for index, result in enumerate(shard_results):
+        output.extend(result['output'])
+        stdout_parts.append(f"=== shard {index + 1}/{len(shard_results)} ===\n{result['stdout']}")
+    stdout = "\n".join(stdout_parts)
+    return {
+        'stdout': stdout[-max_stdout:],
+        'output': output
+    }
+
+
+def run_ansible_playbook(playbook, inventory, extra_vars=None, progress=None):
+    logger.info("Running playbook", extra={'playbook': playbook})
+    # Each run gets its own private data directory so concurrent runs never collide
+    with run_workspace(get_workspace_root(), keep=config.get("keep_runner_artifacts", False)) as private_data_dir:
+        return run_in_workspace(playbook, inventory, extra_vars, progress, private_data_dir)
+
+
+def run_in_workspace(playbook, inventory, extra_vars, progress, private_data_dir):
+    shard_size = int(config.get("shard_size", 0))
+    hosts = []
+    if shard_size and os.path.isfile(inventory):
+        hosts = list(load_inventory(inventory).hosts)
+    if not shard_size or len(hosts) <= shard_size:
+        return run_playbook_once(playbook, inventory, extra_vars, progress, private_data_dir)
+
+    # Split large inventories into host shards, each run by its own runner and private data dir
+    shards = [hosts[i:i + shard_size] for i in range(0, len(hosts), shard_size)]
+    shard_workers = int(config.get("shard_workers", min(len(shards), os.cpu_count() or 1)))
+    logger.info("Running sharded playbook",
+                extra={'hosts': len(hosts), 'shards': len(shards), 'shard_workers': shard_workers})
+
+    # Each shard reports into its own counters so one shard's stats do not end the whole play
+    shard_progress = progress.shards([len(shard) for shard in shards]) if progress is not None \
+        else [None] * len(shards)
+
+    def run_shard(index, shard_hosts):
+        shard_dir = os.path.join(private_data_dir, f"shard_{uuid.uuid4()}")
+        try:
+            result = run_playbook_once(playbook, inventory, extra_vars, shard_progress[index], shard_dir,
+                                       limit=",".join(shard_hosts))
+            logger.info("Shard finished", extra={'shard': index + 1, 'shards': len(shards),
+                                                 'hosts': len(shard_hosts)})
+            return result
+        except Exception as e:
+            logger.error("Shard failed", extra={'shard': index + 1, 'shards': len(shards), 'error': str(e)})
+            return failed_shard_result(shard_hosts, e)
+
+    with ThreadPoolExecutor(max_workers=shard_workers, thread_name_prefix="shard") as executor:
+        shard_results = list(executor.map(run_shard, range(len(shards)), shards))
+    return merge_shard_results(shard_results)
 
 
 def run_ansible_command(command):
     command.append('-vvv')
-    print(f"Running command: {' '.join(command)}")
+    logger.info("Running command", extra={'command': ' '.join(command)})
     result = subprocess.run(command, check=True)
     return result.returncode
 
@@ -107,17 +339,6 @@ def parse_extra_args(extra_args_str):
     return extra_vars
 
 
-def process_result_default(json_file_path, task_res_file):
-    with open(json_file_path, "r") as file:
-        data = json.load(file)
-    postrun_script_args = data.get("postrun_script_args", [])
-
-    with open(task_res_file, "r") as file:
-        result_json = json.load(file)
-
-    return get_result_array(result_json)
-
-
 def get_result_array(data_task_res):
     hosts = data_task_res["output"]
     scrout = []
@@ -152,33 +373,19 @@ def get_result_array(data_task_res):
     }
 
 
-def ansiMain(json_file, output_file, func_name, task_values, app_context):
+def run_task_spec(task_spec, app_context, progress=None):
+    # In-process entry point: takes the task spec dict and returns the result dict directly
     global config
     global headers
     config = app_context['config']
     headers = app_context['headers']
-    try:
-        with open(json_file, 'r') as f:
-            data = json.load(f)
-
-        playbook = data.get('playbook')
-        inventory = data.get('inventory')
-        extra_vars = data.get('extra_vars', "")
-
-        if not playbook or not inventory:
-            raise ValueError("Both 'playbook' and 'inventory' are required fields.")
-
-        ewars = parse_extra_args(extra_vars)
-        result = run_ansible_playbook(playbook, inventory, ewars)
 
-        if output_file:
-            with open(output_file, 'w') as f:
-                json.dump(result, f, indent=2)
-        return result
+    playbook = task_spec.get('playbook')
+    inventory = task_spec.get('inventory')
+    extra_vars = task_spec.get('extra_vars', "")
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        print("Stack trace:")
-        traceback.print_exc()
-        sys.exit(1)
+    if not playbook or not inventory:
+        raise ValueError("Both 'playbook' and 'inventory' are required fields.")
 
+    ewars = parse_extra_args(extra_vars)
+    return run_ansible_playbook(playbook, inventory, ewars, progress=progress)
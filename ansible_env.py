@@ -0,0 +1,60 @@
+import os
+import threading
+
+_env_lock = threading.Lock()
+_env_cache = {}
+
+
+def get_forks(config):
+    # SSH-bound work scales past the core count; split the budget across concurrent runs
+    if config.get("ansible_forks"):
+        return int(config.get("ansible_forks"))
+    per_cpu = int(config.get("ansible_forks_per_cpu", 4))
+    concurrent_runs = int(config.get("max_concurrent_tasks") or os.cpu_count() or 1)
+    return max(5, (os.cpu_count() or 1) * per_cpu // max(1, concurrent_runs))
+
+
+def get_state_dir(config):
+    return config.get("ansible_state_dir") or os.path.join(os.path.expanduser("~"), ".ansible-agent")
+
+
+def get_ansible_envvars(config):
+    # Agent-wide ansible settings shared by every run, so SSH control sockets and
+    # gathered facts survive from one task to the next against the same hosts
+    state_dir = get_state_dir(config)
+    with _env_lock:
+        envvars = _env_cache.get(state_dir)
+        if envvars is not None:
+            return envvars
+
+        control_path_dir = os.path.join(state_dir, "cp")
+        os.makedirs(control_path_dir, mode=0o700, exist_ok=True)
+
+        persist = config.get("ssh_control_persist", "30m")
+        envvars = {
+            'ANSIBLE_SSH_ARGS': f"-o ControlMaster=auto -o ControlPersist={persist}",
+            'ANSIBLE_SSH_CONTROL_PATH_DIR': control_path_dir,
+            'ANSIBLE_PIPELINING': str(bool(config.get("ansible_pipelining", True))),
+            'ANSIBLE_GATHERING': 'smart',
+            'ANSIBLE_CACHE_PLUGIN_TIMEOUT': str(int(config.get("fact_cache_ttl", 3600))),
+        }
+        plugin = config.get("fact_cache_plugin", "jsonfile")
+        if plugin != "jsonfile":
+            # ansible-runner only manages jsonfile caches; other plugins are configured directly
+            envvars['ANSIBLE_CACHE_PLUGIN'] = plugin
+            if config.get("fact_cache_connection"):
+                envvars['ANSIBLE_CACHE_PLUGIN_CONNECTION'] = config.get("fact_cache_connection")
+        _env_cache[state_dir] = envvars
+        return envvars
+
+
+def get_fact_cache_settings(config):
+    # ansible-runner overwrites the cache plugin env vars with a fact_cache directory inside the
+    # run's artifact dir, which is deleted after every run. An absolute fact_cache path makes it
+    # use the shared directory instead.
+    plugin = config.get("fact_cache_plugin", "jsonfile")
+    if plugin != "jsonfile":
+        return {'fact_cache_type': plugin}
+    fact_cache_dir = os.path.abspath(os.path.join(get_state_dir(config), "facts"))
+    os.makedirs(fact_cache_dir, mode=0o700, exist_ok=True)
+    return {'fact_cache_type': 'jsonfile', 'fact_cache': fact_cache_dir}
@@ -1,32 +1,79 @@
-import json
-import os
-import uuid
+import logging
+import random
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from config import base_url, app_context
+from payloads import get_limits, build_result_payload, build_log_payload, build_status_message
+from metrics import timed, inc_counter
+from agent_log import debug_payload, debug_dump
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    # One pooled keep-alive session shared by every worker thread
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                config = app_context['config']
+                pool_size = int(config.get("http_pool_size", 10))
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.verify = False
+                _session = session
+    return _session
+
+
+def send_request(method, url, **kwargs):
+    # Retry 5xx responses and connection errors with exponential backoff and full jitter
+    config = app_context['config']
+    max_retries = int(config.get("http_max_retries", 3))
+    backoff = float(config.get("http_backoff", 0.5))
+    kwargs.setdefault("timeout", (float(config.get("http_connect_timeout", 10)),
+                                  float(config.get("http_read_timeout", 60))))
+    kwargs.setdefault("headers", app_context['headers'])
+
+    attempt = 0
+    while True:
+        try:
+            response = get_session().request(method, url, **kwargs)
+            if response.status_code < 500 or attempt >= max_retries:
+                return response
+            logger.warning("Request failed, retrying",
+                           extra={'method': method, 'url': url, 'status_code': response.status_code})
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt >= max_retries:
+                raise
+            logger.warning("Request failed, retrying", extra={'method': method, 'url': url, 'error': str(e)})
+        attempt += 1
+        inc_counter("agent_http_retries_total", labels={'method': method})
+        time.sleep(random.uniform(0, backoff * (2 ** attempt)))
 
 
 def execute_get_request(url, app_context):
-    response = requests.get(url, headers=app_context['headers'], verify=False)
+    with timed("fetch_tasks"):
+        response = send_request("GET", url, headers=app_context['headers'])
     if response.status_code == 200:
         data = response.json()
-        print(json.dumps(data, indent=4))
-        filepath = os.path.join('/tmp', f"{uuid.uuid4()}.json")
-        print(f"response stored at  {filepath}")
-        try:
-            with open(filepath, 'w') as f:
-                json.dump(data, f, indent=2)
-            print(f"JSON data successfully stored in {filepath}")
-        except Exception as e:
-            print(f"Error storing JSON data: {e}")
-        return response.json()
+        debug_payload(logger, "getTasks response", data)
+        debug_dump(logger, "getTasks", data)
+        return data
     else:
         return None
 
 
 def execute_post_request(url, payload):
-    response = requests.post(url, headers=app_context['headers'], json=payload, verify=False)
+    response = send_request("POST", url, json=payload)
     return response
 
 
@@ -35,13 +82,13 @@ def post_task_event(task_id, task_status, task_logs, progressPercentage):
     payload = {
         "taskId": f"{task_id}",
         "status": task_status,
-        "logMessage": f"{task_logs}",
+        "logMessage": build_status_message(task_logs, get_limits(app_context['config'])),
         "progressPercentage": progressPercentage
     }
-    with open("/tmp/pyerr.txt", 'w') as f:
-        json.dump(payload, f, indent=2)
+    debug_dump(logger, "updateStatus", payload)
 
-    response = execute_post_request(url, payload)
+    with timed("post_status"):
+        response = execute_post_request(url, payload)
     if response.status_code == 200:
         return response.json()
     else:
@@ -50,16 +97,18 @@ def post_task_event(task_id, task_status, task_logs, progressPercentage):
 
 def post_result(task_id, task_result, task_status, task_logs):
     url = base_url + "/completed"
+    limits = get_limits(app_context['config'])
     payload = {
         "taskId": f"{task_id}",
-        "result": task_result,
+        "result": build_result_payload(task_result, limits),
         "status": task_status,
-        "logMessage": task_logs
+        "logMessage": build_log_payload(task_logs, limits)
     }
-    with open("/tmp/pyerr.txt", 'w') as f:
-        json.dump(payload, f, indent=2)
+    debug_dump(logger, "completed", payload)
 
-    response = execute_post_request(url, payload)
+    with timed("post_result"):
+        response = execute_post_request(url, payload)
+    inc_counter("agent_tasks_total", labels={'status': task_status})
     if response.status_code == 200:
         return response.json()
     else:
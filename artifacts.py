@@ -0,0 +1,37 @@
+import json
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+_artifact_queue = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+
+def _write_artifacts():
+    while True:
+        data, path = _artifact_queue.get()
+        try:
+            with open(path, 'w') as f:
+                json.dump(data, f, separators=(',', ':'), default=str)
+        except Exception as e:
+            logger.error("Error writing artifact", extra={'path': path, 'error': str(e)})
+        finally:
+            _artifact_queue.task_done()
+
+
+def write_artifact_async(data, path):
+    # Compact JSON audit copy written off the task's critical path
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=_write_artifacts, name="artifact-writer", daemon=True)
+            _writer_thread.start()
+    _artifact_queue.put((data, path))
+
+
+def flush_artifacts():
+    # Block until every queued artifact has been written
+    _artifact_queue.join()
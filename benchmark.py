@@ -0,0 +1,543 @@
+"""Offline throughput benchmark for the agent.
+
+Runs the agent against a local stand-in task portal, stubbed CloudDNA/SentinelOne
+endpoints and a synthetic ansible event stream, then prints one JSON line with
+tasks/sec, task latency percentiles, peak RSS and bytes posted.
+
+    python benchmark.py agent --tasks 50 --hosts 200
+    python benchmark.py events --hosts 20000 --tasks-per-host 10
+    python benchmark.py edr --tasks 200 --accounts 5
+    python benchmark.py leases --tasks 200 --agents 4 --kill-agents 1
+"""
+import argparse
+import base64
+import json
+import os
+import re
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def synthetic_inventory(hosts, group="all_hosts", label=None):
+    # A comment label makes each task's inventory text, and so its content key, distinct
+    lines = [f"# {label}"] if label else []
+    lines.append(f"[{group}]")
+    lines.extend(f"host{i:05d} ansible_host=10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}" for i in range(hosts))
+    return "\n".join(lines) + "\n"
+
+
+def synthetic_task_node(index, hosts, trigger="patch", sub_type="LINUX_PATCH", identical=False):
+    inventory = synthetic_inventory(hosts, label=None if identical else f"bench task {index}")
+    task_input = {
+        'template': base64.b64encode(b"{}").decode('ascii'),
+        'inventory': base64.b64encode(inventory.encode('utf-8')).decode('ascii'),
+        'trigger': trigger,
+    }
+    return {
+        'taskId': f"bench-{index}",
+        'taskName': f"bench task {index}",
+        'taskType': "PATCH",
+        'taskSubType': sub_type,
+        'taskStatus': "PENDING",
+        'taskInput': base64.b64encode(json.dumps(task_input).encode('utf-8')).decode('ascii'),
+    }
+
+
+def synthetic_events(hosts, tasks_per_host, fail_every=0, skip_every=0):
+    # Replays the event sequence ansible-runner emits for a linear play over `hosts`.
+    # Hosts picked by skip_every have every task skipped and only show up in the stats.
+    host_names = [f"host{i:05d}" for i in range(hosts)]
+    stats = {category: {} for category in ('ok', 'failures', 'skipped', 'changed', 'processed')}
+    counter = 0
+    yield {'event': 'playbook_on_start', 'event_data': {}}
+    yield {'event': 'playbook_on_play_start', 'event_data': {'play': 'bench'}}
+    for task_index in range(tasks_per_host):
+        task = f"bench task {task_index}"
+        yield {'event': 'playbook_on_task_start', 'event_data': {'task': task}}
+        for host_index, host in enumerate(host_names):
+            counter += 1
+            stats['processed'][host] = 1
+            if skip_every and host_index % skip_every == skip_every - 1:
+                stats['skipped'][host] = stats['skipped'].get(host, 0) + 1
+                yield {'event': 'runner_on_skipped', 'counter': counter, 'stdout': f"skipping: [{host}]",
+                       'event_data': {'host': host, 'task': task}}
+                continue
+            failed = fail_every and host_index % fail_every == 0 and task_index == tasks_per_host - 1
+            res = {'rc': 1 if failed else 0, 'changed': True,
+                   'stdout': f"{host}: step {task_index} done", 'stdout_lines': [f"step {task_index} done"]}
+            category = 'failures' if failed else 'ok'
+            stats[category][host] = stats[category].get(host, 0) + 1
+            if not failed:
+                stats['changed'][host] = stats['changed'].get(host, 0) + 1
+            yield {
+                'event': 'runner_on_failed' if failed else 'runner_on_ok',
+                'counter': counter,
+                'stdout': f"ok: [{host}]",
+                'event_data': {'host': host, 'task': task, 'res': res},
+            }
+    yield {'event': 'playbook_on_stats', 'event_data': stats}
+
+
+class ReplayRunner:
+    # Minimal stand-in for ansible_runner.Runner built from a synthetic event stream.
+    # Like the real runner, only events the handler asks to keep are stored, and stats
+    # come from the stored playbook_on_stats event.
+
+    def __init__(self, private_data_dir, hosts, tasks_per_host, event_handler=None, status_handler=None,
+                 fail_every=0, skip_every=0):
+        self.config = type('RunnerConfig', (), {})()
+        self.config.artifact_dir = os.path.join(private_data_dir, 'artifacts', 'bench')
+        os.makedirs(self.config.artifact_dir, exist_ok=True)
+        self.events = []
+        if status_handler:
+            status_handler({'status': 'running'}, None)
+        with open(os.path.join(self.config.artifact_dir, 'stdout'), 'w') as stdout:
+            for event in synthetic_events(hosts, tasks_per_host, fail_every=fail_every, skip_every=skip_every):
+                if event.get('stdout'):
+                    stdout.write(event['stdout'] + '\n')
+                if event_handler is None or event_handler(event):
+                    self.events.append(event)
+        failed = fail_every and hosts
+        if status_handler:
+            status_handler({'status': 'failed' if failed else 'successful'}, None)
+        self.rc = 2 if failed else 0
+        self.status = 'failed' if failed else 'successful'
+
+    @property
+    def stats(self):
+        for event in self.events:
+            if event['event'] == 'playbook_on_stats':
+                return event['event_data']
+        return None
+
+
+class BenchState:
+    def __init__(self, task_nodes, redeliver=False):
+        self.lock = threading.Lock()
+        self.nodes = list(task_nodes)
+        self.pending = list(task_nodes)
+        # With redeliver set, /getTasks keeps returning every task without a result,
+        # as the portal does when several agents poll it
+        self.redeliver = redeliver
+        self.dispatched = {}
+        self.completed = {}
+        self.completions = {}
+        self.leases = {}
+        self.reclaimed = 0
+        self.bytes_posted = 0
+        self.requests = {}
+        self.accounts_seen = set()
+
+    def count(self, path, size):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            self.bytes_posted += size
+
+
+def claim_lease(state, payload):
+    # Grant the lease unless the task is finished or another agent holds an unexpired lease
+    task_id, agent_id = payload.get('taskId'), payload.get('agentId')
+    now = time.time()
+    with state.lock:
+        if task_id in state.completed:
+            return False
+        holder = state.leases.get(task_id)
+        if holder and holder[0] != agent_id:
+            if holder[1] > now:
+                return False
+            state.reclaimed += 1
+        state.leases[task_id] = (agent_id, now + float(payload.get('leaseSeconds', 300)))
+        return True
+
+
+def renew_leases(state, payload):
+    agent_id = payload.get('agentId')
+    expires = time.time() + float(payload.get('leaseSeconds', 300))
+    renewed = []
+    with state.lock:
+        for task_id in payload.get('taskIds', []):
+            if state.leases.get(task_id, (None,))[0] == agent_id:
+                state.leases[task_id] = (agent_id, expires)
+                renewed.append(task_id)
+    return renewed
+
+
+def make_handler(state):
+    class BenchHandler(BaseHTTPRequestHandler):
+        def _send_json(self, data, status=200):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_body(self):
+            length = int(self.headers.get('Content-Length', 0))
+            return self.rfile.read(length) if length else b""
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            state.count(path, 0)
+            if path.endswith('/getTasks'):
+                with state.lock:
+                    if state.redeliver:
+                        nodes = [node for node in state.nodes if node['taskId'] not in state.completed]
+                    else:
+                        nodes, state.pending = state.pending, []
+                    now = time.perf_counter()
+                    for node in nodes:
+                        state.dispatched.setdefault(node['taskId'], now)
+                self._send_json({'success': True, 'result': {'tasks': [nodes] if nodes else []}})
+            elif path.endswith('/sites'):
+                # Every account seen so far has an active site named after its service ID
+                with state.lock:
+                    sites = [{'name': f"svc-{a}", 'registrationToken': f"tok-{a}"} for a in state.accounts_seen]
+                query = self.path.split('?', 1)[1] if '?' in self.path else ""
+                match = re.search(r'(?:^|&)name=([^&]+)', query)
+                if match:
+                    names = set(unquote(match.group(1)).split(','))
+                    sites = [site for site in sites if site['name'] in names]
+                self._send_json({'data': {'sites': sites}, 'pagination': {'nextCursor': None}})
+            else:
+                self._send_json({'error': 'not found'}, 404)
+
+        def do_POST(self):
+            path = self.path.split('?')[0]
+            body = self._read_body()
+            state.count(path, len(body))
+            if path.endswith('/completed'):
+                payload = json.loads(body or b"{}")
+                with state.lock:
+                    task_id = payload.get('taskId')
+                    state.completed[task_id] = time.perf_counter()
+                    state.completions[task_id] = state.completions.get(task_id, 0) + 1
+                self._send_json({'success': True})
+            elif path.endswith('/claimTask'):
+                payload = json.loads(body or b"{}")
+                self._send_json({'success': True, 'result': {'claimed': claim_lease(state, payload)}})
+            elif path.endswith('/renewLease'):
+                payload = json.loads(body or b"{}")
+                self._send_json({'success': True, 'result': {'renewed': renew_leases(state, payload)}})
+            elif path.endswith('/releaseTask'):
+                payload = json.loads(body or b"{}")
+                with state.lock:
+                    if state.leases.get(payload.get('taskId'), (None,))[0] == payload.get('agentId'):
+                        del state.leases[payload['taskId']]
+                self._send_json({'success': True})
+            elif path.endswith('/updateStatus'):
+                self._send_json({'success': True})
+            elif path.endswith('/oauth2/app/token'):
+                self._send_json({'access_token': 'bench-token', 'expires_in': 3600})
+            elif path.endswith('/graphql'):
+                variables = json.loads(body or b"{}").get('variables') or {}
+                with state.lock:
+                    state.accounts_seen.update(variables.values())
+                if 'accountId' in variables:
+                    data = {'account': {'services': [{'serviceId': f"svc-{variables['accountId']}"}]}}
+                else:
+                    data = {alias: {'services': [{'serviceId': f"svc-{account}"}]}
+                            for alias, account in variables.items()}
+                self._send_json({'data': data})
+            else:
+                self._send_json({'error': 'not found'}, 404)
+
+        def log_message(self, format, *args):
+            pass
+
+    return BenchHandler
+
+
+def start_server(state):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(state))
+    threading.Thread(target=server.serve_forever, name="bench-portal", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class BenchContext(dict):
+    # app_context is read both as a mapping and through attributes in the agent
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def stub_edr_endpoints(edr, url):
+    edr.CLOUDDNA_TOKEN_URL = f"{url}/oauth2/app/token"
+    edr.CLOUDDNA_GRAPHQL_URL = f"{url}/graphql"
+    edr.SENTINELONE_SITES_URL = f"{url}/web/api/v2.1/sites"
+    edr.configure_graphql(validate=False)
+
+
+def bench_events(args):
+    from ansi_utils import HostResultAggregator
+
+    tmp_dir = tempfile.mkdtemp(prefix="bench_events_")
+    try:
+        aggregator = HostResultAggregator(max_host_stdout=args.max_host_stdout,
+                                          event_log_path=os.path.join(tmp_dir, 'events.jsonl')
+                                          if args.event_log else None)
+        tracemalloc.start()
+        start = time.perf_counter()
+        events = 0
+        for event in synthetic_events(args.hosts, args.tasks_per_host, fail_every=args.fail_every,
+                                      skip_every=args.skip_every):
+            aggregator.event_handler(event)
+            events += 1
+        aggregator.close()
+        elapsed = time.perf_counter() - start
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {
+        'mode': 'events',
+        'hosts': args.hosts,
+        'events': events,
+        'seconds': round(elapsed, 4),
+        'events_per_sec': round(events / elapsed, 1) if elapsed else 0.0,
+        'traced_peak_mb': round(traced_peak / 1024.0 / 1024.0, 2),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def configure_agent(url, tmp_dir, args, **config):
+    # Point the agent at the stand-in portal with an in-memory config
+    import main
+    import api
+
+    config.update({
+        'playbooks': {'linux_updates': 'bench.yml'},
+        'playbooks_dir': tmp_dir + os.sep,
+        'max_concurrent_tasks': args.workers,
+        'runner_workspace_root': os.path.join(tmp_dir, 'runner'),
+        'progress_interval': args.progress_interval,
+        'http_max_retries': 0,
+    })
+    context = BenchContext(config=config, headers={'Content-Type': 'application/json'})
+    main.app_context = context
+    api.app_context = context
+    main.base_url = url
+    api.base_url = url
+    main.tasks_dir = tmp_dir + os.sep
+    return main
+
+
+def bench_agent(args):
+    import ansi_utils
+
+    task_nodes = [synthetic_task_node(i, args.hosts, identical=args.identical_tasks) for i in range(args.tasks)]
+    state = BenchState(task_nodes)
+    server, url = start_server(state)
+    tmp_dir = tempfile.mkdtemp(prefix="bench_agent_")
+    try:
+        main = configure_agent(url, tmp_dir, args, result_mode=args.result_mode)
+
+        def replay_run(private_data_dir=None, event_handler=None, status_handler=None, **kwargs):
+            return ReplayRunner(private_data_dir, args.hosts, args.tasks_per_host,
+                                event_handler=event_handler, status_handler=status_handler,
+                                fail_every=args.fail_every, skip_every=args.skip_every)
+
+        ansi_utils.ansible_runner.run = replay_run
+
+        start = time.perf_counter()
+        main.execute_tasks()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    latencies = [state.completed[task_id] - dispatched
+                 for task_id, dispatched in state.dispatched.items() if task_id in state.completed]
+    return {
+        'mode': 'agent',
+        'tasks': args.tasks,
+        'hosts_per_task': args.hosts,
+        'completed': len(state.completed),
+        'seconds': round(elapsed, 4),
+        'tasks_per_sec': round(len(state.completed) / elapsed, 2) if elapsed else 0.0,
+        'latency_p50': round(percentile(latencies, 50), 4),
+        'latency_p99': round(percentile(latencies, 99), 4),
+        'bytes_posted': state.bytes_posted,
+        'requests': state.requests,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def bench_edr(args):
+    import main
+
+    main.app_context = BenchContext(config={'clouddna_validate_queries': False}, headers={})
+    edr = main.get_edr_utils()
+    state = BenchState([])
+    server, url = start_server(state)
+    try:
+        stub_edr_endpoints(edr, url)
+        accounts = [f"acct{i % args.accounts}" for i in range(args.tasks)]
+        latencies = []
+        start = time.perf_counter()
+        if args.prefetch:
+            edr.prefetch_linux_edr_configs("bench-client", "bench-secret", "bench-s1", accounts)
+        for account in accounts:
+            task_start = time.perf_counter()
+            edr.install_sentinel_one("bench-client", "bench-secret", "bench-s1", "bench-key", account)
+            latencies.append(time.perf_counter() - task_start)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+    return {
+        'mode': 'edr',
+        'installs': args.tasks,
+        'accounts': args.accounts,
+        'seconds': round(elapsed, 4),
+        'installs_per_sec': round(args.tasks / elapsed, 1) if elapsed else 0.0,
+        'latency_p50': round(percentile(latencies, 50), 6),
+        'latency_p99': round(percentile(latencies, 99), 6),
+        'requests': state.requests,
+        'bytes_posted': state.bytes_posted,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def leases_agent(args):
+    # One agent process of leases mode: main's daemon loop with portal leases, stopped by
+    # SIGTERM from the parent. A killed agent exits as soon as its first playbook starts,
+    # so it dies holding leases without a result, a release or further heartbeats.
+    import ansi_utils
+
+    tmp_dir = tempfile.mkdtemp(prefix=f"agent{args.agent_index}_", dir=args.work_dir)
+    dies = args.agent_index < args.kill_agents
+    main = configure_agent(args.portal_url, tmp_dir, args,
+                           coordination="portal",
+                           agent_id=f"bench-agent-{args.agent_index}",
+                           lease_ttl=args.lease_ttl,
+                           lease_heartbeat=args.lease_ttl / 3.0,
+                           poll_min_interval=args.lease_ttl / 4.0,
+                           poll_max_interval=args.lease_ttl / 2.0)
+
+    def replay_run(private_data_dir=None, event_handler=None, status_handler=None, **kwargs):
+        if dies:
+            os._exit(1)
+        time.sleep(args.task_seconds)
+        return ReplayRunner(private_data_dir, 1, 1, event_handler=event_handler, status_handler=status_handler)
+
+    ansi_utils.ansible_runner.run = replay_run
+    main.run_agent()
+    if main.lease_manager is not None:
+        main.lease_manager.stop()
+    return None
+
+
+def bench_leases(args):
+    # Several agent processes drain one portal through leases; killed agents die mid-task
+    # so their leases must expire and be reclaimed by the survivors
+    task_nodes = [synthetic_task_node(i, 1) for i in range(args.tasks)]
+    state = BenchState(task_nodes, redeliver=True)
+    server, url = start_server(state)
+    work_dir = tempfile.mkdtemp(prefix="bench_leases_")
+    command = [sys.executable, os.path.abspath(__file__), 'leases-agent', '--portal-url', url,
+               '--work-dir', work_dir, '--workers', str(args.workers), '--kill-agents', str(args.kill_agents),
+               '--lease-ttl', str(args.lease_ttl), '--task-seconds', str(args.task_seconds),
+               '--progress-interval', str(args.progress_interval)]
+    start = time.perf_counter()
+    agents = [subprocess.Popen(command + ['--agent-index', str(i)], stdout=subprocess.DEVNULL)
+              for i in range(args.agents)]
+    try:
+        while time.perf_counter() - start < args.timeout:
+            with state.lock:
+                done = len(state.completed) >= args.tasks
+            if done or all(agent.poll() is not None for agent in agents):
+                break
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - start
+    finally:
+        for agent in agents:
+            if agent.poll() is None:
+                agent.send_signal(signal.SIGTERM)
+        for agent in agents:
+            agent.wait()
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        'mode': 'leases',
+        'tasks': args.tasks,
+        'agents': args.agents,
+        'killed_agents': args.kill_agents,
+        'completed': len(state.completed),
+        'duplicate_runs': sum(count - 1 for count in state.completions.values()),
+        'reclaimed_leases': state.reclaimed,
+        'seconds': round(elapsed, 4),
+        'tasks_per_sec': round(len(state.completed) / elapsed, 2) if elapsed else 0.0,
+        'requests': state.requests,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline agent benchmark")
+    parser.add_argument('mode', choices=['agent', 'events', 'edr', 'leases', 'leases-agent'])
+    parser.add_argument('--tasks', type=int, default=20)
+    parser.add_argument('--hosts', type=int, default=100)
+    parser.add_argument('--tasks-per-host', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--accounts', type=int, default=5)
+    parser.add_argument('--identical-tasks', action='store_true',
+                        help="give every task the same inventory, so identical work is run once")
+    parser.add_argument('--prefetch', action='store_true', help="resolve EDR accounts in one batch first")
+    parser.add_argument('--fail-every', type=int, default=0, help="fail one host in every N")
+    parser.add_argument('--skip-every', type=int, default=0, help="skip every task on one host in every N")
+    parser.add_argument('--result-mode', default="compact", choices=['compact', 'summary', 'detailed'])
+    parser.add_argument('--max-host-stdout', type=int, default=65536)
+    parser.add_argument('--event-log', action='store_true', help="stream verbose events to disk")
+    parser.add_argument('--progress-interval', type=float, default=1.0)
+    parser.add_argument('--agents', type=int, default=2, help="concurrent agents in leases mode")
+    parser.add_argument('--kill-agents', type=int, default=0, help="agents that die holding a lease")
+    parser.add_argument('--lease-ttl', type=float, default=2.0)
+    parser.add_argument('--task-seconds', type=float, default=0.01, help="simulated run time per task")
+    parser.add_argument('--timeout', type=float, default=120.0, help="give up on leases mode after this long")
+    # Set by leases mode for its agent processes
+    parser.add_argument('--portal-url', help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--agent-index', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--output', help="append the JSON result line to this file")
+    return parser.parse_args(argv)
+
+
+def main_entry(argv=None):
+    args = parse_args(argv)
+    result = {'agent': bench_agent, 'events': bench_events, 'edr': bench_edr,
+              'leases': bench_leases, 'leases-agent': leases_agent}[args.mode](args)
+    if result is None:
+        return None
+    line = json.dumps(result, sort_keys=True)
+    print(line)
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(line + '\n')
+    return result
+
+
+if __name__ == "__main__":
+    main_entry()
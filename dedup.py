@@ -0,0 +1,73 @@
+import hashlib
+import threading
+
+from edr_cache import TTLCache
+
+
+def task_content_key(playbook, extra_vars, inventory_text):
+    # Identical playbook, vars and inventory produce identical work
+    digest = hashlib.sha256()
+    for part in (playbook or "", extra_vars or "", inventory_text or ""):
+        digest.update(part.encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class TaskIndex:
+    # Tracks in-flight and recently completed taskIds so a task the portal returns again
+    # is not run twice, and optionally remembers results by content key for reuse.
+    # Runs in progress are also indexed by content key, so identical work prepared while
+    # one is running attaches to it instead of running again.
+
+    def __init__(self, recent_ttl=3600, result_ttl=0, max_entries=4096):
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.recent = TTLCache(ttl=recent_ttl, max_entries=max_entries)
+        self.results = TTLCache(ttl=result_ttl, max_entries=max_entries) if result_ttl else None
+        self.running = {}
+
+    def claim(self, task_id):
+        with self.lock:
+            if task_id in self.in_flight or self.recent.get(task_id) is not None:
+                return False
+            self.in_flight.add(task_id)
+            return True
+
+    def release(self, task_id):
+        # Give up a claim without marking the task completed, e.g. when another agent holds it
+        with self.lock:
+            self.in_flight.discard(task_id)
+
+    def is_in_flight(self, task_id):
+        with self.lock:
+            return task_id in self.in_flight
+
+    def complete(self, task_id):
+        with self.lock:
+            self.in_flight.discard(task_id)
+        self.recent.set(task_id, True)
+
+    def attach(self, content_key, members):
+        # True when identical work is already running and `members` now wait for its result;
+        # False when the caller owns the content key and must detach() it once its run is over
+        with self.lock:
+            followers = self.running.get(content_key)
+            if followers is None:
+                self.running[content_key] = []
+                return False
+            followers.extend(members)
+            return True
+
+    def detach(self, content_key):
+        # Members that attached to the finished run
+        with self.lock:
+            return self.running.pop(content_key, None) or []
+
+    def remember_result(self, content_key, result):
+        if self.results is not None and content_key:
+            self.results.set(content_key, result)
+
+    def cached_result(self, content_key):
+        if self.results is None or not content_key:
+            return None
+        return self.results.get(content_key)
@@ -0,0 +1,70 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    # Thread-safe mapping with per-entry expiry and least-recently-used eviction.
+    # When persist_path is set, entries are saved to and reloaded from a JSON file.
+
+    def __init__(self, ttl=3600, max_entries=1024, persist_path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.persist_path = persist_path
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        if persist_path:
+            self._load()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (value, time.time() + (self.ttl if ttl is None else ttl))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            if self.persist_path:
+                self._save()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.persist_path:
+                self._save()
+
+    def _load(self):
+        try:
+            with open(self.persist_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, (value, expires_at) in data.items():
+            if expires_at > now:
+                self.entries[key] = (value, expires_at)
+
+    def _save(self):
+        tmp_path = f"{self.persist_path}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({key: list(entry) for key, entry in self.entries.items()}, f, separators=(',', ':'))
+            os.replace(tmp_path, self.persist_path)
+        except OSError as e:
+            logger.error("Error persisting cache", extra={'path': self.persist_path, 'error': str(e)})
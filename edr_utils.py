@@ -2,8 +2,14 @@ import requests
 import json
 from gql import gql, Client
 from gql.transport.requests import RequestsHTTPTransport
+from graphql import print_schema
 import logging
-import traceback
+import os
+import threading
+import time
+
+from edr_cache import TTLCache
+from metrics import timed
 
 # Configure logging
 logging.basicConfig(
@@ -12,6 +18,129 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Refresh OAuth tokens this many seconds before they actually expire
+TOKEN_EXPIRY_SKEW = 60
+
+token_cache = TTLCache(ttl=3000, max_entries=16)
+service_id_cache = TTLCache(ttl=3600, max_entries=1024)
+site_token_cache = TTLCache(ttl=3600, max_entries=1024)
+# Serialises cache misses so concurrent installs for one account share a single lookup chain
+lookup_lock = threading.Lock()
+
+CLOUDDNA_TOKEN_URL = "https://api.v3.clouddna.autodesk.com/oauth2/app/token"
+CLOUDDNA_GRAPHQL_URL = "https://api.v3.clouddna.autodesk.com/graphql"
+SENTINELONE_SITES_URL = "https://autodesk.sentinelone.net/web/api/v2.1/sites"
+# Site names sent per filtered listing request, keeping the query string a sane length
+SITE_NAME_BATCH = 50
+
+SERVICE_ID_QUERY = gql("""
+    query Query($accountId: ID) {
+        account(id: $accountId) {
+            services {
+                serviceId
+            }
+        }
+    }
+""")
+
+# Long-lived GraphQL client state; the sync session is not thread-safe, so it is used under graphql_lock
+graphql_lock = threading.Lock()
+graphql_transport = None
+graphql_session = None
+graphql_settings = {
+    'schema_path': None,
+    'validate': True,
+    'refresh_interval': 86400,
+}
+schema_refresh_thread = None
+
+
+def configure_edr_cache(ttl=3600, max_entries=1024, persist_dir=None):
+    """Configure lookup caches; service IDs and site tokens can be persisted under persist_dir"""
+    global service_id_cache, site_token_cache
+    service_id_path = None
+    site_token_path = None
+    if persist_dir:
+        os.makedirs(persist_dir, exist_ok=True)
+        service_id_path = os.path.join(persist_dir, 'service_ids.json')
+        site_token_path = os.path.join(persist_dir, 'site_tokens.json')
+    service_id_cache = TTLCache(ttl=ttl, max_entries=max_entries, persist_path=service_id_path)
+    site_token_cache = TTLCache(ttl=ttl, max_entries=max_entries, persist_path=site_token_path)
+
+
+def configure_graphql(schema_path=None, validate=True, refresh_interval=86400):
+    """Configure the cached schema file, local query validation and schema refresh interval"""
+    graphql_settings['schema_path'] = schema_path
+    graphql_settings['validate'] = validate
+    graphql_settings['refresh_interval'] = refresh_interval
+
+
+def load_cached_schema():
+    """Read the cached SDL schema, or None if there is no usable cache file"""
+    schema_path = graphql_settings['schema_path']
+    if not schema_path or not os.path.exists(schema_path):
+        return None
+    with open(schema_path, 'r') as f:
+        return f.read()
+
+
+def save_schema(schema):
+    schema_path = graphql_settings['schema_path']
+    if not schema_path or schema is None:
+        return
+    tmp_path = f"{schema_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(print_schema(schema))
+    os.replace(tmp_path, schema_path)
+
+
+def refresh_schema():
+    """Re-fetch the schema over the shared session and update the cache file"""
+    try:
+        with graphql_lock:
+            graphql_session.fetch_schema()
+            save_schema(graphql_session.client.schema)
+        logger.info("Refreshed CloudDNA GraphQL schema")
+    except Exception as e:
+        logger.error(f"Failed to refresh CloudDNA GraphQL schema: {str(e)}")
+
+
+def schema_is_stale():
+    schema_path = graphql_settings['schema_path']
+    if not schema_path or not os.path.exists(schema_path):
+        return False
+    return time.time() - os.path.getmtime(schema_path) > graphql_settings['refresh_interval']
+
+
+def get_graphql_session(access_token: str):
+    """Return the shared CloudDNA GraphQL session, authorised with access_token"""
+    global graphql_transport, graphql_session, schema_refresh_thread
+    with graphql_lock:
+        if graphql_session is None:
+            graphql_transport = RequestsHTTPTransport(url=CLOUDDNA_GRAPHQL_URL, retries=3)
+            schema = load_cached_schema() if graphql_settings['validate'] else None
+            # Only introspect when validation is wanted and no cached schema exists yet
+            fetch_schema = graphql_settings['validate'] and schema is None
+            graphql_transport.headers = {'Authorization': f'Bearer {access_token}'}
+            client = Client(transport=graphql_transport, schema=schema, fetch_schema_from_transport=fetch_schema)
+            graphql_session = client.connect_sync()
+            if fetch_schema:
+                save_schema(client.schema)
+
+    if graphql_settings['validate'] and schema_is_stale() and \
+            (schema_refresh_thread is None or not schema_refresh_thread.is_alive()):
+        schema_refresh_thread = threading.Thread(target=refresh_schema, name="graphql-schema-refresh", daemon=True)
+        schema_refresh_thread.start()
+    return graphql_session
+
+
+def execute_graphql(access_token: str, query, variables=None) -> dict:
+    """Run a query on the shared CloudDNA GraphQL session"""
+    session = get_graphql_session(access_token)
+    with graphql_lock:
+        graphql_transport.headers = {'Authorization': f'Bearer {access_token}'}
+        return session.execute(query, variable_values=variables)
+
 
 def get_win_edr_config(cid):
     return {
@@ -35,16 +164,25 @@ def install_sentinel_one(client_id: str, client_secret: str, sentinel_api_token:
                          account_id: str) -> dict:
     """Main function to get SentinelOne installation tokens"""
     try:
-        # Get CloudDNA access token
-        access_token = get_clouddna_token(client_id, client_secret)
-
-        # Get service ID
-        print(f"ACC TOK {access_token} {account_id}")
-        service_id = get_service_id(access_token, account_id)
+        # Get service ID, minting a CloudDNA access token only on a cache miss
+        service_id = service_id_cache.get(account_id)
+        if service_id is None:
+            with lookup_lock:
+                service_id = service_id_cache.get(account_id)
+                if service_id is None:
+                    access_token = get_cached_clouddna_token(client_id, client_secret)
+                    service_id = get_service_id(access_token, account_id)
+                    service_id_cache.set(account_id, service_id)
 
         # Get SentinelOne site token
-        print(f"SID {service_id}")
-        site_token = get_site_token(sentinel_api_token, service_id)
+        logger.debug(f"Resolved service ID {service_id} for account {account_id}")
+        site_token = site_token_cache.get(service_id)
+        if site_token is None:
+            with lookup_lock:
+                site_token = site_token_cache.get(service_id)
+                if site_token is None:
+                    site_token = get_site_token(sentinel_api_token, service_id)
+                    site_token_cache.set(service_id, site_token)
 
         return {
             'service_id': service_id,
@@ -57,22 +195,37 @@ def install_sentinel_one(client_id: str, client_secret: str, sentinel_api_token:
         raise
 
 
+def get_cached_clouddna_token(client_id: str, client_secret: str) -> str:
+    """Get a CloudDNA access token, reusing the previous one until it expires"""
+    access_token = token_cache.get(client_id)
+    if access_token is None:
+        access_token, expires_in = get_clouddna_token_with_expiry(client_id, client_secret)
+        token_cache.set(client_id, access_token, ttl=max(expires_in - TOKEN_EXPIRY_SKEW, 0))
+    return access_token
+
+
 def get_clouddna_token(client_id: str, client_secret: str) -> str:
     """Get access token from CloudDNA API"""
+    return get_clouddna_token_with_expiry(client_id, client_secret)[0]
+
+
+def get_clouddna_token_with_expiry(client_id: str, client_secret: str) -> tuple:
+    """Get access token and its lifetime in seconds from CloudDNA API"""
     try:
-        url = "https://api.v3.clouddna.autodesk.com/oauth2/app/token"
+        url = CLOUDDNA_TOKEN_URL
         data = {
             "client_id": client_id,
             "client_secret": client_secret
         }
         headers = {'Content-type': 'application/json'}
 
-        response = requests.post(url, data=json.dumps(data), headers=headers)
+        with timed("clouddna_token"):
+            response = requests.post(url, data=json.dumps(data), headers=headers)
         response.raise_for_status()
 
-        access_token = response.json()['access_token']
+        token_data = response.json()
         logger.info("Successfully obtained CloudDNA access token")
-        return access_token
+        return token_data['access_token'], int(token_data.get('expires_in', 3600))
 
     except requests.exceptions.RequestException as e:
         logger.error(f"Failed to get CloudDNA access token: {str(e)}")
@@ -82,27 +235,9 @@ def get_clouddna_token(client_id: str, client_secret: str) -> str:
 def get_service_id(access_token: str, account_id: str) -> str:
     """Get ServiceID for the specified AWS account"""
     try:
-        api_endpoint = "https://api.v3.clouddna.autodesk.com/graphql"
-        transport = RequestsHTTPTransport(
-            url=api_endpoint,
-            headers={'Authorization': f'Bearer {access_token}'}
-        )
-
-        client = Client(transport=transport, fetch_schema_from_transport=True)
-
-        query = gql("""
-            query Query($accountId: ID) {
-                account(id: $accountId) {
-                    services {
-                        serviceId
-                    }
-                }
-            }
-        """)
-
         variables = {'accountId': account_id}
-        result = client.execute(query, variable_values=variables)
-        print(f" res {result} ")
+        with timed("service_id"):
+            result = execute_graphql(access_token, SERVICE_ID_QUERY, variables)
 
         if not result.get('account', {}).get('services'):
             raise ValueError(f"No services found for account {account_id}")
@@ -112,22 +247,22 @@ def get_service_id(access_token: str, account_id: str) -> str:
         return service_id
 
     except Exception as e:
-        print(traceback.format_exc())
-        logger.error(f"Failed to get service ID: {str(e)}")
+        logger.exception(f"Failed to get service ID: {str(e)}")
         raise
 
 
 def get_site_token(sentinel_api_token: str, service_id: str) -> str:
     """Get SentinelOne site token using service ID"""
     try:
-        url = "https://autodesk.sentinelone.net/web/api/v2.1/sites"
+        url = SENTINELONE_SITES_URL
         params = {
             'name': service_id,
             'state': 'active'
         }
         headers = {'Authorization': f'ApiToken {sentinel_api_token}'}
 
-        response = requests.get(url, params=params, headers=headers)
+        with timed("site_token"):
+            response = requests.get(url, params=params, headers=headers)
         response.raise_for_status()
 
         data = response.json()
@@ -146,3 +281,73 @@ def get_site_token(sentinel_api_token: str, service_id: str) -> str:
     except Exception as e:
         logger.error(f"Failed to complete SentinelOne installation process: {str(e)}")
         raise
+
+
+def get_service_ids(access_token: str, account_ids: list) -> dict:
+    """Get ServiceIDs for many accounts with a single aliased GraphQL query"""
+    aliases = {f"account{i}": account_id for i, account_id in enumerate(account_ids)}
+    variable_defs = ", ".join(f"${alias}: ID" for alias in aliases)
+    fields = "\n".join(f"{alias}: account(id: ${alias}) {{ services {{ serviceId }} }}" for alias in aliases)
+    query = gql(f"query BatchQuery({variable_defs}) {{\n{fields}\n}}")
+
+    with timed("service_id_batch"):
+        result = execute_graphql(access_token, query, aliases)
+
+    service_ids = {}
+    for alias, account_id in aliases.items():
+        services = (result.get(alias) or {}).get('services')
+        if services:
+            service_ids[account_id] = services[0]['serviceId']
+        else:
+            logger.warning(f"No services found for account {account_id}")
+    return service_ids
+
+
+def get_site_tokens(sentinel_api_token: str, service_ids: list) -> dict:
+    """Get SentinelOne site tokens for many service IDs from active-site listings filtered by name"""
+    url = SENTINELONE_SITES_URL
+    headers = {'Authorization': f'ApiToken {sentinel_api_token}'}
+    names = list(dict.fromkeys(service_ids))
+    wanted = set(names)
+    site_tokens = {}
+    for start in range(0, len(names), SITE_NAME_BATCH):
+        cursor = None
+        while True:
+            params = {'state': 'active', 'name': ",".join(names[start:start + SITE_NAME_BATCH]), 'limit': 1000}
+            if cursor:
+                params['cursor'] = cursor
+            with timed("site_token_batch"):
+                response = requests.get(url, params=params, headers=headers)
+            response.raise_for_status()
+            data = response.json()
+            for site in data.get('data', {}).get('sites', []):
+                name = site.get('name')
+                if name in wanted:
+                    site_tokens[name] = site['registrationToken']
+                    wanted.discard(name)
+            cursor = (data.get('pagination') or {}).get('nextCursor')
+            if not cursor:
+                break
+    for service_id in wanted:
+        logger.warning(f"No active site found for service ID {service_id}")
+    return site_tokens
+
+
+def prefetch_linux_edr_configs(client_id: str, client_secret: str, sentinel_api_token: str, account_ids) -> None:
+    """Resolve service IDs and site tokens for a batch of accounts into the lookup caches"""
+    try:
+        with lookup_lock:
+            missing_accounts = [a for a in dict.fromkeys(account_ids) if a and service_id_cache.get(a) is None]
+            if missing_accounts:
+                access_token = get_cached_clouddna_token(client_id, client_secret)
+                for account_id, service_id in get_service_ids(access_token, missing_accounts).items():
+                    service_id_cache.set(account_id, service_id)
+
+            service_ids = [service_id_cache.get(a) for a in dict.fromkeys(account_ids) if a]
+            missing_services = [s for s in dict.fromkeys(service_ids) if s and site_token_cache.get(s) is None]
+            if missing_services:
+                for service_id, site_token in get_site_tokens(sentinel_api_token, missing_services).items():
+                    site_token_cache.set(service_id, site_token)
+    except Exception as e:
+        # Each task still falls back to its own lookup chain in install_sentinel_one
+        logger.error(f"Failed to prefetch SentinelOne installation tokens: {str(e)}")
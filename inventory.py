@@ -0,0 +1,288 @@
+import hashlib
+import logging
+import os
+import re
+import shlex
+import string
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+
+from metrics import inc_counter, set_gauge
+
+logger = logging.getLogger(__name__)
+
+HOST_RANGE = re.compile(r"\[([0-9a-zA-Z]+):([0-9a-zA-Z]+)(?::([0-9]+))?\]")
+
+
+def expand_host_range(pattern):
+    # Host names from an INI range as ansible expands them: web[01:50].example.com keeps the
+    # zero padding, db-[a:f] walks letters, an optional third field is the step
+    match = HOST_RANGE.search(pattern)
+    if match is None:
+        return [pattern]
+    head, tail = pattern[:match.start()], pattern[match.end():]
+    begin, end, step = match.group(1), match.group(2), int(match.group(3) or 1)
+    if begin.isdigit() and end.isdigit():
+        width = len(begin) if begin.startswith("0") and len(begin) > 1 else 0
+        if width and len(end) != width:
+            raise ValueError(f"host range must use equal-length begin and end: {pattern}")
+        names = [str(number).zfill(width) for number in range(int(begin), int(end) + 1, step or 1)]
+    elif len(begin) == 1 and len(end) == 1 and begin.isalpha() and end.isalpha():
+        first, last = string.ascii_letters.index(begin), string.ascii_letters.index(end)
+        names = list(string.ascii_letters[first:last + 1:step or 1])
+    else:
+        raise ValueError(f"invalid host range: {pattern}")
+    if not names:
+        raise ValueError(f"host range is empty: {pattern}")
+    hosts = []
+    for name in names:
+        hosts.extend(expand_host_range(head + name + tail))
+    return hosts
+
+
+class Inventory:
+    # Parsed INI inventory. Host and group names are interned so the same host seen in
+    # many tasks' inventories is stored once; host lines keep their inline vars verbatim.
+    # Host ranges are expanded, each host getting its own line with the range's vars.
+    # `mixed_hosts` are hosts listed with different inline vars in different groups.
+
+    __slots__ = ('digest', 'hosts', 'host_lines', 'groups', 'sections', 'mixed_hosts')
+
+    def __init__(self, inventory_text, digest=None):
+        self.digest = digest or inventory_digest(inventory_text)
+        hosts = []
+        mixed_hosts = set()
+        self.host_lines = {}
+        groups = {}
+        sections = {}
+        section = "ungrouped"
+        for raw_line in inventory_text.splitlines():
+            line = raw_line.strip()
+            if not line or line.startswith(("#", ";")):
+                continue
+            if line.startswith("[") and line.endswith("]"):
+                section = sys.intern(line[1:-1])
+                continue
+            if section.endswith(":vars") or section.endswith(":children"):
+                sections.setdefault(section, []).append(line)
+                continue
+            token = line.split()[0]
+            for name in expand_host_range(token):
+                host = sys.intern(name)
+                host_line = name + line[len(token):]
+                if host not in self.host_lines:
+                    self.host_lines[host] = host_line
+                    hosts.append(host)
+                elif self.host_lines[host] != host_line:
+                    mixed_hosts.add(host)
+                groups.setdefault(section, []).append(host)
+        self.hosts = tuple(hosts)
+        self.groups = {group: tuple(dict.fromkeys(members)) for group, members in groups.items()}
+        self.sections = {section: tuple(lines) for section, lines in sections.items()}
+        self.mixed_hosts = frozenset(mixed_hosts)
+
+    @property
+    def host_count(self):
+        return len(self.hosts)
+
+    def host_vars(self, host):
+        # Inline vars from the host's line, e.g. "web1 ansible_host=10.0.0.1"
+        line = self.host_lines.get(host)
+        if line is None:
+            return {}
+        pairs = (token.split("=", 1) for token in shlex.split(line)[1:] if "=" in token)
+        return {sys.intern(key): value for key, value in pairs}
+
+    def group_hosts(self, group):
+        # Hosts in a group, including those of its :children groups
+        if group == "all":
+            return self.hosts
+        members = []
+        seen = set()
+        pending = [group]
+        visited = set()
+        while pending:
+            current = pending.pop()
+            if current in visited:
+                continue
+            visited.add(current)
+            for host in self.groups.get(current, ()):
+                if host not in seen:
+                    seen.add(host)
+                    members.append(host)
+            pending.extend(self.sections.get(f"{current}:children", ()))
+        return tuple(members)
+
+    def groups_of(self, host):
+        # Every group the host belongs to, directly or through :children
+        direct = {group for group, members in self.groups.items() if host in members}
+        if not direct:
+            return set()
+        parents = {}
+        for section, children in self.sections.items():
+            if section.endswith(":children"):
+                for child in children:
+                    parents.setdefault(child, []).append(section[:-len(":children")])
+        result = set()
+        pending = list(direct)
+        while pending:
+            group = pending.pop()
+            if group in result:
+                continue
+            result.add(group)
+            pending.extend(parents.get(group, ()))
+        result.add("all")
+        return result
+
+
+def inventory_digest(inventory_text):
+    return hashlib.sha256(inventory_text.encode('utf-8')).hexdigest()
+
+
+class InventoryCache:
+    # Parsed inventories keyed by content hash, so identical inventories across tasks are
+    # parsed once, plus content-addressed inventory files that tasks can share on disk.
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.paths = {}
+
+    def get(self, inventory_text):
+        digest = inventory_digest(inventory_text)
+        with self.lock:
+            inventory = self.entries.get(digest)
+            if inventory is not None:
+                self.entries.move_to_end(digest)
+                inc_counter("agent_inventory_cache_total", labels={'result': 'hit'})
+                return inventory
+        inventory = Inventory(inventory_text, digest)
+        inc_counter("agent_inventory_cache_total", labels={'result': 'miss'})
+        with self.lock:
+            self.entries[digest] = inventory
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                self.paths = {path: key for path, key in self.paths.items() if key != evicted}
+            set_gauge("agent_inventory_cache_entries", len(self.entries))
+        return inventory
+
+    def path_for(self, inventory_text, directory):
+        # Write the inventory once under its hash; later tasks reuse the file and refresh its mtime
+        # so artifact eviction keeps inventories that are still in use
+        inventory = self.get(inventory_text)
+        path = os.path.join(directory, f"inventory_{inventory.digest}.ini")
+        if os.path.exists(path):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        else:
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(inventory_text)
+            os.replace(tmp_path, path)
+            logger.debug("Created inventory file", extra={'path': path, 'hosts': inventory.host_count})
+        with self.lock:
+            self.paths[path] = inventory.digest
+        return path
+
+    def load(self, path):
+        # Inventory behind a file path, without re-reading files this cache wrote
+        with self.lock:
+            digest = self.paths.get(path)
+            inventory = self.entries.get(digest) if digest else None
+        if inventory is not None:
+            return inventory
+        with open(path, 'r') as f:
+            return self.get(f.read())
+
+
+inventory_cache = InventoryCache()
+
+
+def configure_inventory_cache(max_entries=256):
+    global inventory_cache
+    inventory_cache = InventoryCache(max_entries=max_entries)
+
+
+def get_inventory(inventory_text):
+    return inventory_cache.get(inventory_text)
+
+
+def inventory_file(inventory_text, directory):
+    return inventory_cache.path_for(inventory_text, directory)
+
+
+def load_inventory(path):
+    return inventory_cache.load(path)
+
+
+def list_inventory_hosts(inventory_text):
+    # Host names from an INI inventory, in order of first appearance
+    return list(get_inventory(inventory_text).hosts)
+
+
+class InventoryMerge:
+    # Union of INI inventories built one inventory at a time. add() refuses an inventory that
+    # disagrees on group vars, group children or the inline vars of a shared host, and leaves
+    # the merge unchanged when it does.
+
+    def __init__(self):
+        self.groups = {}
+        self.sections = None
+        self.host_lines = {}
+
+    @property
+    def host_count(self):
+        return len(self.host_lines)
+
+    def new_hosts(self, inventory):
+        # Hosts the inventory would add, or None when it cannot be merged
+        if inventory.mixed_hosts:
+            return None
+        if self.sections is not None and inventory.sections != self.sections:
+            return None
+        added = set()
+        for host, line in inventory.host_lines.items():
+            known = self.host_lines.get(host)
+            if known is None:
+                added.add(host)
+            elif known != line:
+                return None
+        return added
+
+    def add(self, inventory):
+        if self.new_hosts(inventory) is None:
+            return False
+        if self.sections is None:
+            self.sections = inventory.sections
+        for group, members in inventory.groups.items():
+            merged = self.groups.setdefault(group, {})
+            for host in members:
+                line = inventory.host_lines[host]
+                self.host_lines.setdefault(host, line)
+                merged.setdefault(host, line)
+        return True
+
+    def text(self):
+        out = []
+        for group, lines in self.groups.items():
+            out.append(f"[{group}]")
+            out.extend(lines.values())
+        for section, lines in (self.sections or {}).items():
+            out.append(f"[{section}]")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+
+def merge_inventories(inventory_texts):
+    # Union of several INI inventories, or None when they cannot be merged
+    merge = InventoryMerge()
+    for inventory_text in inventory_texts:
+        if not merge.add(get_inventory(inventory_text)):
+            return None
+    return merge.text()
@@ -0,0 +1,28 @@
+import importlib
+import sys
+import threading
+import time
+
+# name -> (seconds, number of modules the import pulled in)
+import_times = {}
+_import_lock = threading.Lock()
+
+
+def lazy_import(name):
+    # Import a heavy subsystem the first time it is needed and record what that cost
+    if name in import_times:
+        return sys.modules[name]
+    with _import_lock:
+        if name not in import_times:
+            modules_before = len(sys.modules)
+            start = time.perf_counter()
+            importlib.import_module(name)
+            import_times[name] = (time.perf_counter() - start, len(sys.modules) - modules_before)
+    return sys.modules[name]
+
+
+def format_import_profile():
+    lines = [f"{'module':<28} {'seconds':>9} {'modules':>8}"]
+    for name, (seconds, modules) in sorted(import_times.items(), key=lambda item: -item[1][0]):
+        lines.append(f"{name:<28} {seconds:>9.3f} {modules:>8}")
+    return "\n".join(lines)
@@ -0,0 +1,192 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from metrics import set_gauge, inc_counter
+
+logger = logging.getLogger(__name__)
+
+
+class PortalLeaseBackend:
+    # Leases granted by the task portal through /claimTask, /renewLease and /releaseTask.
+    # The portal owns expiry, so a lease abandoned by a dead agent is handed out again.
+
+    def __init__(self, base_url, post):
+        self.base_url = base_url
+        self.post = post
+
+    def claim(self, task_id, agent_id, ttl):
+        response = self.post(self.base_url + "/claimTask",
+                             {"taskId": f"{task_id}", "agentId": agent_id, "leaseSeconds": ttl})
+        if response.status_code != 200:
+            return False
+        return bool((response.json().get("result") or {}).get("claimed"))
+
+    def renew(self, task_ids, agent_id, ttl):
+        response = self.post(self.base_url + "/renewLease",
+                             {"taskIds": [f"{task_id}" for task_id in task_ids], "agentId": agent_id,
+                              "leaseSeconds": ttl})
+        if response.status_code != 200:
+            raise RuntimeError(f"renewLease returned {response.status_code}")
+        return (response.json().get("result") or {}).get("renewed", [])
+
+    def release(self, task_id, agent_id):
+        self.post(self.base_url + "/releaseTask", {"taskId": f"{task_id}", "agentId": agent_id})
+
+
+class LockDirLeaseBackend:
+    # Leases kept as one file per task in a directory shared by the agents on a host.
+    # An flock on the directory's guard file makes every check-and-set atomic.
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.guard_path = os.path.join(path, ".guard")
+
+    @contextmanager
+    def guard(self):
+        with open(self.guard_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def lease_path(self, task_id):
+        return os.path.join(self.path, quote(f"{task_id}", safe="") + ".lease")
+
+    def read(self, task_id):
+        try:
+            with open(self.lease_path(task_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write(self, task_id, agent_id, ttl):
+        path = self.lease_path(task_id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"agentId": agent_id, "expires": time.time() + ttl}, f)
+        os.replace(tmp_path, path)
+
+    def claim(self, task_id, agent_id, ttl):
+        with self.guard():
+            lease = self.read(task_id)
+            if lease and lease["agentId"] != agent_id:
+                if lease["expires"] > time.time():
+                    return False
+                logger.info("Reclaiming expired lease", extra={'task_id': task_id, 'previous_agent': lease["agentId"]})
+            self.write(task_id, agent_id, ttl)
+            return True
+
+    def renew(self, task_ids, agent_id, ttl):
+        renewed = []
+        with self.guard():
+            for task_id in task_ids:
+                lease = self.read(task_id)
+                if lease and lease["agentId"] == agent_id:
+                    self.write(task_id, agent_id, ttl)
+                    renewed.append(task_id)
+        return renewed
+
+    def release(self, task_id, agent_id):
+        with self.guard():
+            lease = self.read(task_id)
+            if lease and lease["agentId"] == agent_id:
+                os.remove(self.lease_path(task_id))
+
+
+class LeaseManager:
+    # Claims tasks for this agent through a lease backend and renews every held lease
+    # from a heartbeat thread, so several agents can drain one portal without running
+    # a task twice. `affinity` limits the agent to matching taskType/taskSubType values.
+
+    def __init__(self, backend, agent_id, ttl=300, heartbeat_interval=None, affinity=None):
+        self.backend = backend
+        self.agent_id = agent_id
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval or max(ttl / 3.0, 1.0)
+        self.affinity = {value.upper() for value in affinity or []}
+        self.lock = threading.Lock()
+        self.held = set()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def accepts(self, task_node):
+        if not self.affinity:
+            return True
+        return ((task_node.get('taskType') or "").upper() in self.affinity
+                or (task_node.get('taskSubType') or "").upper() in self.affinity)
+
+    def claim(self, task_id):
+        try:
+            claimed = self.backend.claim(task_id, self.agent_id, self.ttl)
+        except Exception as e:
+            logger.warning("Lease claim failed", extra={'task_id': task_id, 'error': str(e)})
+            return False
+        inc_counter("agent_lease_claims_total", labels={'result': 'claimed' if claimed else 'taken'})
+        if claimed:
+            with self.lock:
+                self.held.add(task_id)
+                set_gauge("agent_leases_held", len(self.held))
+            self.start()
+        return claimed
+
+    def release(self, task_id):
+        with self.lock:
+            if task_id not in self.held:
+                return
+            self.held.discard(task_id)
+            set_gauge("agent_leases_held", len(self.held))
+        try:
+            self.backend.release(task_id, self.agent_id)
+        except Exception as e:
+            # The lease simply expires on the portal side
+            logger.warning("Lease release failed", extra={'task_id': task_id, 'error': str(e)})
+
+    def renew(self):
+        with self.lock:
+            task_ids = list(self.held)
+        if not task_ids:
+            return
+        try:
+            renewed = {f"{task_id}" for task_id in self.backend.renew(task_ids, self.agent_id, self.ttl)}
+        except Exception as e:
+            # Keep the leases and retry on the next heartbeat
+            logger.warning("Lease renewal failed", extra={'tasks': len(task_ids), 'error': str(e)})
+            return
+        lost = [task_id for task_id in task_ids if f"{task_id}" not in renewed]
+        if lost:
+            with self.lock:
+                self.held.difference_update(lost)
+                set_gauge("agent_leases_held", len(self.held))
+            for task_id in lost:
+                inc_counter("agent_leases_lost_total")
+                logger.warning("Lost task lease", extra={'task_id': task_id})
+
+    def is_held(self, task_id):
+        with self.lock:
+            return task_id in self.held
+
+    def _run(self):
+        while not self.stop_event.wait(self.heartbeat_interval):
+            self.renew()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="lease-heartbeat", daemon=True)
+                self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        for task_id in list(self.held):
+            self.release(task_id)
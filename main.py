@@ -1,13 +1,51 @@
 import json
+import logging
 import os
 from datetime import datetime
 import uuid
 import base64
-from api import execute_get_request, post_task_event, post_result
+import signal
+import socket
+import sys
+import threading
+import time
+from api import execute_get_request, execute_post_request, post_task_event, post_result
 from config import load_config, app_context, base_url, task_portal_client_id, task_portal_client_secret, \
     adsk_portal_client_id, adsk_portal_client_secret, sentinel_token, tasks_dir, sentinel_api_key, playbooks_dir
-from pyscript.edr_utils import get_win_edr_config, get_linux_edr_config
-from ansi_utils import ansiMain
+from artifacts import write_artifact_async, flush_artifacts
+from inventory import list_inventory_hosts, merge_inventories, get_inventory, inventory_file, configure_inventory_cache, \
+    InventoryMerge
+from progress import ProgressReporter
+from pipeline import TaskPipeline
+from workspace import ArtifactStore
+from task_store import TaskStore, PREPARED, RUNNING, EXECUTED, REPORTED
+from dedup import TaskIndex, task_content_key
+from leases import LeaseManager, PortalLeaseBackend, LockDirLeaseBackend
+from scheduler import TaskScheduler, RuntimeEstimator, parse_deadline
+from profiling import TaskProfiler, should_profile, format_profile_summary
+from lazy import lazy_import, format_import_profile
+from agent_log import configure_logging, stop_logging, debug_payload
+from metrics import timed, add_gauge, start_metrics_server, start_metrics_file_writer
+
+logger = logging.getLogger(__name__)
+
+task_type_running = {}
+task_type_running_lock = threading.Lock()
+shutdown_event = threading.Event()
+task_store = None
+task_index = None
+lease_manager = None
+task_scheduler = None
+task_pipeline = None
+# Set whenever a task leaves the pipeline (freeing capacity) and on shutdown
+pipeline_event = threading.Event()
+last_eviction = 0.0
+edr_utils_lock = threading.Lock()
+edr_utils_module = None
+
+# ansible_runner (via ansi_utils) and gql (via edr_utils) are only imported once a task needs them
+ANSI_UTILS_MODULE = "ansi_utils"
+EDR_UTILS_MODULE = "pyscript.edr_utils"
 
 
 def get_playbook_path(taskType, taskSubType):
@@ -28,18 +66,34 @@ def default_handler(*args):
     return {}
 
 
+def get_edr_utils():
+    # Import and configure the EDR lookup layer on first use
+    global edr_utils_module
+    with edr_utils_lock:
+        if edr_utils_module is None:
+            module = lazy_import(EDR_UTILS_MODULE)
+            module.configure_edr_cache(ttl=int(app_context.config.get("edr_cache_ttl", 3600)),
+                                       max_entries=int(app_context.config.get("edr_cache_size", 1024)),
+                                       persist_dir=app_context.config.get("edr_cache_dir"))
+            module.configure_graphql(schema_path=app_context.config.get("clouddna_schema_path"),
+                                     validate=app_context.config.get("clouddna_validate_queries", True),
+                                     refresh_interval=int(app_context.config.get("clouddna_schema_refresh", 86400)))
+            edr_utils_module = module
+    return edr_utils_module
+
+
 def install_linux_edr(*args):
     # Implement Linux EDR specific logic here
     # Return dictionary with required key-value pairs
-    print(f"LNX {args}")
+    logger.debug("Resolving Linux EDR config", extra={'edr_args': args})
     account_id = args[0]
-    return get_linux_edr_config(adsk_portal_client_id, adsk_portal_client_secret, sentinel_token, sentinel_api_key,
-                                account_id)
+    return get_edr_utils().get_linux_edr_config(adsk_portal_client_id, adsk_portal_client_secret, sentinel_token,
+                                                sentinel_api_key, account_id)
 
 
 def install_win_edr(*args):
     try:
-        return get_win_edr_config(args[0])
+        return get_edr_utils().get_win_edr_config(args[0])
     except ImportError:
         # Fallback values if import fails
         return {
@@ -51,7 +105,6 @@ def prepare_json(taskType, taskSubType, template_data_str, inventory_path, task_
     # Read template JSON file
 
     # Get task specific values based on task_type
-    print(f"\n\n{template_data_str}")
     template_data = {}  # json.loads(template_data_str)
     task_handlers = {
         "install_win_edr": install_win_edr,
@@ -74,7 +127,7 @@ def prepare_json(taskType, taskSubType, template_data_str, inventory_path, task_
     template_data["inventory"] = inventory_path
     template_data["playbook"] = app_context.config.get("playbooks_dir") + get_playbook_path(taskType, taskSubType)
 
-    print(f"TASK JSON {template_data}")
+    debug_payload(logger, "Prepared task spec", template_data, task_id=task_id)
     return template_data
 
 
@@ -85,162 +138,744 @@ def write_to_file(data, file_path):
                 file.writelines(line + '\n' for line in data)
             else:
                 file.write(str(data))
-        print(f"Data written successfully to {file_path}")
+        logger.debug("Data written", extra={'path': file_path})
 
     except Exception as e:
-        print(f"Error writing to file: {e}")
-
+        logger.error("Error writing to file", extra={'path': file_path, 'error': str(e)})
 
-def get_result_array(data_task_res):
-    hosts = data_task_res["output"]
-    scrout = []
-    for host in hosts:
-        hostname = host["hostId"]
-        finalout = host["hostDetails"]["finalout"]
 
-        proc_rc = host["hostDetails"]["return_code"]  # finalout.get("return_code", "")
-
-        if isinstance(finalout, dict):
-            stdout_value = finalout.get("stdout", "")
-        else:
-            # Handle the case where finalout is a string
-            stdout_value = finalout
+def run_ansible(task_data, progress=None, result_file_name=None):
+    # Task spec and results stay in memory; the result file is only an optional audit artifact
+    ansi_utils = lazy_import(ANSI_UTILS_MODULE)
+    result = ansi_utils.run_task_spec(task_data, app_context, progress=progress)
+    if result_file_name:
+        write_artifact_async(result, result_file_name)
+    dockerlogs = result
+    final_res = ansi_utils.get_result_array(result)
 
-        output_code = 1200
-        output_status = "Successfuly Done!"
+    resdict = {}
+    resdict["dockerlogs"] = dockerlogs
+    resdict["final_res"] = final_res
 
-        if proc_rc != 0:
-            output_code = 1501
-            output_status = "Task Failed"
+    # Process the output
+    return resdict
 
-        hout = {
-            'hostname': hostname,
-            'code': output_code,
-            'stdout': stdout_value,
-            'status': output_status
-        }
-        scrout.append(hout)
 
-    final_out = {
-        'taskstatus': scrout,
-        'data_task_res': hosts
+def acquire_task_type_slot(taskSubType):
+    # Per task-type concurrency limit, e.g. {"WINDOWS_PATCH": 2}. Checked when a task is
+    # admitted, so a task over its type's limit waits in the backlog instead of holding a worker.
+    limits = app_context.config.get("task_type_limits") or {}
+    key = (taskSubType or "").upper()
+    limit = limits.get(key)
+    with task_type_running_lock:
+        running = task_type_running.get(key, 0)
+        if limit and running >= int(limit):
+            return False
+        task_type_running[key] = running + 1
+    return True
+
+
+def release_task_type_slot(taskSubType):
+    key = (taskSubType or "").upper()
+    with task_type_running_lock:
+        task_type_running[key] = max(0, task_type_running.get(key, 0) - 1)
+
+
+def decode_task(taskNode):
+    # print(taskNode['taskInput'])
+    with timed("decode"):
+        taskRaw = base64.b64decode(taskNode['taskInput'])
+        task = json.loads(taskRaw)
+        task['taskId'] = taskNode['taskId']
+
+        task['template'] = base64.b64decode(task['template']).decode('utf-8')
+        task['inventory'] = base64.b64decode(task['inventory']).decode('utf-8')
+        # Extra args (e.g. the account ID for install_linux_edr) come from the task input
+        task['eargs'] = task.get('eargs') or ""
+    return task
+
+
+def decode_tasks(taskNodes):
+    # Each poll cycle decodes a task once; a failed decode is kept for the prepare stage to report
+    decoded = {}
+    for taskNode in taskNodes:
+        try:
+            decoded[taskNode['taskId']] = decode_task(taskNode)
+        except Exception as e:
+            decoded[taskNode['taskId']] = e
+    return decoded
+
+
+def prefetch_edr_tokens(taskNodes, decoded):
+    # Resolve every Linux EDR account in the batch together instead of one lookup chain per task
+    account_ids = []
+    for taskNode in taskNodes:
+        task = decoded[taskNode['taskId']]
+        if isinstance(task, Exception):
+            continue
+        if task.get('trigger') == "install_linux_edr" and task['eargs']:
+            account_ids.append(task['eargs'])
+    if account_ids:
+        get_edr_utils().prefetch_linux_edr_configs(adsk_portal_client_id, adsk_portal_client_secret, sentinel_token, account_ids)
+
+
+def get_task_store():
+    global task_store
+    if task_store is None:
+        task_store = TaskStore(app_context.config.get("task_store_path") or os.path.join(tasks_dir, "agent_tasks.db"))
+    return task_store
+
+
+def finish_task(taskId, status, result, logs):
+    # The result is stored before posting so a crash or failed post never forces a re-run
+    store = get_task_store()
+    store.save_result(taskId, status, result, logs)
+    try:
+        if not ensure_lease(taskId):
+            return False
+        if post_result(taskId, result, status, logs) is not None:
+            store.set_state(taskId, REPORTED)
+            release_lease(taskId)
+            return True
+        logger.warning("Result not accepted, will re-post on the next cycle", extra={'task_id': taskId})
+        return False
+    finally:
+        # Still in flight until the post returns, so the poll thread does not re-post it meanwhile
+        get_task_index().complete(taskId)
+
+
+def get_task_index():
+    global task_index
+    if task_index is None:
+        task_index = TaskIndex(recent_ttl=float(app_context.config.get("dedup_recent_ttl", 3600)),
+                               result_ttl=float(app_context.config.get("dedup_result_ttl", 0)))
+    return task_index
+
+
+def resume_tasks(taskNodes):
+    # Re-post results computed before a crash, then re-queue tasks interrupted before they produced one
+    store = get_task_store()
+    for taskId, status, result, logs in list(store.unreported_results()):
+        if get_task_index().is_in_flight(taskId):
+            # Still in the pipeline; its report stage posts it
+            continue
+        logger.info("Re-posting stored result", extra={'task_id': taskId})
+        try:
+            if not ensure_lease(taskId):
+                continue
+            if post_result(taskId, result, status, logs) is not None:
+                store.set_state(taskId, REPORTED)
+                release_lease(taskId)
+        except Exception as e:
+            logger.error("Error re-posting result", extra={'task_id': taskId, 'error': str(e)})
+
+    pending = []
+    for taskNode in taskNodes:
+        if store.get_state(taskNode['taskId']) in (EXECUTED, REPORTED):
+            logger.info("Skipping task, its result is already stored", extra={'task_id': taskNode['taskId']})
+            continue
+        store.record_fetched(taskNode)
+    seen = set()
+    for taskNode in store.interrupted_nodes() + taskNodes:
+        if taskNode['taskId'] in seen or store.get_state(taskNode['taskId']) in (EXECUTED, REPORTED):
+            continue
+        seen.add(taskNode['taskId'])
+        pending.append(taskNode)
+    store.purge_reported(float(app_context.config.get("task_store_retention", 7 * 86400)))
+    return pending
+
+
+def get_lease_manager():
+    # Only set up when several agents share one portal ("portal") or one host ("lockdir")
+    global lease_manager
+    mode = app_context.config.get("coordination")
+    if not mode:
+        return None
+    if lease_manager is None:
+        if mode == "lockdir":
+            backend = LockDirLeaseBackend(app_context.config.get("lease_dir") or os.path.join(tasks_dir, "leases"))
+        else:
+            backend = PortalLeaseBackend(base_url, execute_post_request)
+        ttl = float(app_context.config.get("lease_ttl", 300))
+        lease_manager = LeaseManager(backend,
+                                     agent_id=app_context.config.get("agent_id") or f"{socket.gethostname()}-{os.getpid()}",
+                                     ttl=ttl,
+                                     heartbeat_interval=float(app_context.config.get("lease_heartbeat", ttl / 3.0)),
+                                     affinity=app_context.config.get("task_affinity"))
+    return lease_manager
+
+
+def release_lease(taskId):
+    leases = get_lease_manager()
+    if leases is not None:
+        leases.release(taskId)
+
+
+def ensure_lease(taskId):
+    # Whether this agent may still act on the task. A lapsed lease is only ours again if no other
+    # agent claimed the task meanwhile; otherwise the task is dropped here and left to that agent.
+    leases = get_lease_manager()
+    if leases is None or leases.is_held(taskId) or leases.claim(taskId):
+        return True
+    logger.warning("Lease lost, leaving task to the agent that holds it", extra={'task_id': taskId})
+    get_task_store().forget(taskId)
+    return False
+
+
+def claim_tasks(taskNodes):
+    # Drop tasks that are already running, were completed recently or belong to another agent.
+    # Called for each group as it is admitted, so leases are only held for work about to start.
+    leases = get_lease_manager()
+    claimed = []
+    for taskNode in taskNodes:
+        taskId = taskNode['taskId']
+        if leases is not None and not leases.accepts(taskNode):
+            logger.debug("Skipping task outside this agent's affinity", extra={'task_id': taskId})
+            get_task_store().forget(taskId)
+            continue
+        if not get_task_index().claim(taskId):
+            logger.info("Skipping duplicate task", extra={'task_id': taskId})
+            continue
+        if leases is not None and not leases.claim(taskId):
+            logger.info("Skipping task leased by another agent", extra={'task_id': taskId})
+            get_task_index().release(taskId)
+            get_task_store().forget(taskId)
+            continue
+        claimed.append(taskNode)
+    claimed_ids = {taskNode['taskId'] for taskNode in claimed}
+    get_task_scheduler().forget([taskNode['taskId'] for taskNode in taskNodes if taskNode['taskId'] not in claimed_ids])
+    return claimed
+
+
+def coalesce_tasks(taskNodes, decoded):
+    # Group tasks that resolve to the same playbook and vars so they share one runner invocation
+    if not app_context.config.get("coalesce_tasks"):
+        return [[taskNode] for taskNode in taskNodes]
+    max_hosts = int(app_context.config.get("coalesce_max_hosts", 0))
+    groups = []
+    buckets = {}
+    for taskNode in taskNodes:
+        task = decoded[taskNode['taskId']]
+        if isinstance(task, Exception):
+            # Let the prepare stage report the decode failure
+            groups.append([taskNode])
+            continue
+        key = ((taskNode.get('taskSubType') or "").upper(), task.get('trigger'), task['eargs'])
+        try:
+            inventory = get_inventory(task['inventory'])
+        except ValueError:
+            # e.g. an invalid host range; the prepare stage reports it
+            groups.append([taskNode])
+            continue
+        for bucket in buckets.setdefault(key, []):
+            # Each bucket keeps its merged hosts, so a candidate is checked against them only
+            added = bucket['merge'].new_hosts(inventory)
+            if added is None or (max_hosts and bucket['merge'].host_count + len(added) > max_hosts):
+                continue
+            bucket['merge'].add(inventory)
+            bucket['nodes'].append(taskNode)
+            break
+        else:
+            bucket = {'nodes': [taskNode], 'merge': InventoryMerge()}
+            bucket['merge'].add(inventory)
+            buckets[key].append(bucket)
+            groups.append(bucket['nodes'])
+    for group in groups:
+        if len(group) > 1:
+            logger.info("Coalesced tasks into one run",
+                        extra={'task_ids': [taskNode['taskId'] for taskNode in group]})
+    return groups
+
+
+def get_task_scheduler():
+    global task_scheduler
+    if task_scheduler is None:
+        estimator = RuntimeEstimator(alpha=float(app_context.config.get("runtime_ewma_alpha", 0.3)),
+                                     default=float(app_context.config.get("runtime_default_estimate", 300)),
+                                     persist_path=app_context.config.get("runtime_estimates_path")
+                                     or os.path.join(tasks_dir, "runtime_estimates.json"))
+        task_scheduler = TaskScheduler(estimator,
+                                       priorities=app_context.config.get("task_priorities"),
+                                       default_priority=float(app_context.config.get("default_task_priority", 0)),
+                                       aging_rate=float(app_context.config.get("priority_aging_rate", 1.0)),
+                                       deadline_horizon=float(app_context.config.get("deadline_horizon", 900)))
+    return task_scheduler
+
+
+def schedule_tasks(groups, decoded):
+    # Run urgent, high-priority and short work first instead of in /getTasks order
+    entries = []
+    for group in groups:
+        deadlines = []
+        for taskNode in group:
+            task = decoded[taskNode['taskId']]
+            if isinstance(task, Exception):
+                # Let the prepare stage report the decode failure
+                task = {}
+            deadline = parse_deadline(taskNode.get('deadline') or task.get('deadline'))
+            if deadline is not None:
+                deadlines.append(deadline)
+        entries.append({
+            'group': group,
+            'task_ids': [taskNode['taskId'] for taskNode in group],
+            'task_sub_type': group[0].get('taskSubType'),
+            'playbook': get_playbook_path(group[0].get('taskType'), group[0].get('taskSubType') or ""),
+            'deadline': min(deadlines) if deadlines else None,
+        })
+    return get_task_scheduler().order(entries)
+
+
+def split_result(final_res, hosts):
+    # Per-task view of a coalesced run's result
+    hosts = set(hosts)
+    return {
+        'taskstatus': [row for row in final_res['taskstatus'] if row['hostname'] in hosts],
+        'data_task_res': [row for row in final_res['data_task_res'] if row['hostId'] in hosts],
     }
-    return final_out
 
 
-def process_result_default(json_file_path, task_res_file):
-    # Read the JSON file
-    with open(json_file_path, "r") as file:
-        data = json.load(file)
-    # Access the 'postrun_script_args' list
-    postrun_script_args = data.get("postrun_script_args", [])
+def member_result(job, member):
+    final_res = job['resdict']["final_res"]
+    if len(job['members']) == 1:
+        return final_res
+    return split_result(final_res, member['hosts'])
 
-    # Read the JSON file
-    with open(task_res_file, "r") as file:
-        result_json = json.load(file)
 
-    json_obj = get_result_array(result_json)
-    return json_obj
-
-
-def run_ansible(task_file_name, result_file_name, trigger, eargs):
-    result = ansiMain(task_file_name, result_file_name, trigger, eargs, app_context)
-    dockerlogs = result
-    final_res = process_result_default(task_file_name, result_file_name)
-    print(f"{final_res}")
+def split_logs(final_res, hosts, task_count):
+    # A coalesced run's stdout covers every member's hosts; each task's log only gets its own
+    hosts = set(hosts)
+    lines = [f"Coalesced run of {task_count} tasks, showing this task's {len(hosts)} hosts"]
+    for row in final_res['data_task_res']:
+        if row['hostId'] in hosts:
+            details = row['hostDetails']
+            lines.append(f"=== {row['hostId']} (rc {details.get('return_code')}) ===")
+            if details.get('stdout'):
+                lines.append(details['stdout'].rstrip("\n"))
+    return "\n".join(lines)
 
-    resdict = {}
-    resdict["dockerlogs"] = dockerlogs
-    resdict["final_res"] = final_res
 
-    # Process the output
-    return resdict
+def member_logs(job, member):
+    if len(job['members']) == 1:
+        return job['resdict']["dockerlogs"].get("stdout", "")
+    return split_logs(job['resdict']["final_res"], member['hosts'], len(job['members']))
 
 
-def execute_tasks():
-    # Create directories if they do not exist
-    if not os.path.exists(tasks_dir):
-        os.makedirs(tasks_dir)
-    # Generate dynamic filename with timestamp
+def prepare_task(batch):
+    # batch: the group's taskNodes and the cycle's decoded tasks
+    taskNodes = batch['taskNodes']
+    # Generate per-task filenames so concurrent tasks never share files
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     unique_id = str(uuid.uuid4())
 
     task_file_name = f"task_{unique_id}_{timestamp}.json"
     task_file_path = f"{tasks_dir}{task_file_name}"
 
-    inventory_name = f"inventory_{timestamp}_{unique_id}.ini"
-    inventory_file = f"{tasks_dir}{inventory_name}"
-    inventory_file_key = inventory_file
-
     result_file_name = f"task_result_{unique_id}_{timestamp}.json"
     result_file_path = f"{tasks_dir}{result_file_name}"
-    logfilename = f"task_logs_{unique_id}_{timestamp}.log"
+    write_artifacts = app_context.config.get("write_task_artifacts", False)
+
+    members = []
+    for taskNode in taskNodes:
+        taskId = taskNode.get('taskId')
+        try:
+            task = batch['decoded'][taskId]
+            if isinstance(task, Exception):
+                raise task
+            debug_payload(logger, "Decoded task", task, task_id=taskId)
+            members.append({
+                'taskId': taskId,
+                'task': task,
+                'hosts': list_inventory_hosts(task['inventory']),
+            })
+        except Exception as e:
+            logger.error("Error preparing task", extra={'task_id': taskId, 'error': str(e)})
+            finish_task(taskId, 'FAILED', str(e), str(e))
+    if not members:
+        return None
+
+    lead = members[0]
+    task = lead['task']
+    try:
+        taskType = taskNodes[0]['taskType']
+        taskSubType = taskNodes[0]['taskSubType']
 
+        if len(members) == 1:
+            inventory_text = task['inventory']
+        else:
+            inventory_text = merge_inventories([member['task']['inventory'] for member in members])
+        # Inventory files are content-addressed, so tasks sharing an inventory share one file
+        inventory_path = inventory_file(inventory_text, tasks_dir)
+        logger.debug("Using inventory file", extra={'task_id': lead['taskId'], 'path': inventory_path})
+
+        with timed("prepare_json"):
+            task_data = prepare_json(taskType, taskSubType, task['template'], inventory_path,
+                                     task['trigger'], task['taskId'], task['eargs'])
+
+        content_key = task_content_key(task_data['playbook'], task_data.get('extra_vars'), inventory_text)
+        cached = get_task_index().cached_result(content_key)
+        if cached is not None:
+            # Identical work finished recently; reuse its result instead of running again
+            for member in members:
+                logger.info("Reusing recent result", extra={'task_id': member['taskId']})
+                logs = cached['logs'] if len(members) == 1 else \
+                    split_logs(cached['final_res'], member['hosts'], len(members))
+                finish_task(member['taskId'], 'COMPLETED', split_result(cached['final_res'], member['hosts']), logs)
+            return None
+
+        if get_task_index().attach(content_key, members):
+            # Identical work is running; these tasks take its result when it is reported
+            for member in members:
+                logger.info("Attached to identical running task", extra={'task_id': member['taskId']})
+                get_task_store().set_state(member['taskId'], PREPARED)
+            return None
+        batch['content_key'] = content_key
+
+        if write_artifacts:
+            write_artifact_async(task_data, task_file_path)
+            logger.debug("Queued task file", extra={'task_id': lead['taskId'], 'path': task_file_path})
+
+        # post_task_event(taskId,"IN_PROGRESS",task_data,20)
+        for member in members:
+            get_task_store().set_state(member['taskId'], PREPARED)
+        return {
+            'taskId': lead['taskId'],
+            'taskSubType': taskSubType,
+            'playbook': get_playbook_path(taskType, taskSubType),
+            'task': task,
+            'members': members,
+            'inventory_text': inventory_text,
+            'content_key': content_key,
+            'task_data': task_data,
+            'result_file_path': result_file_path if write_artifacts else None,
+        }
+    except Exception as e:
+        logger.error("Error preparing task", extra={'task_id': lead['taskId'], 'error': str(e)})
+        for member in members:
+            finish_task(member['taskId'], 'FAILED', str(e), str(e))
+        return None
+
+
+def execute_job(job):
+    taskId = job['taskId']
+    members = job['members']
+
+    def post_member_events(_taskId, task_status, task_logs, progressPercentage):
+        for member in members:
+            post_task_event(member['taskId'], task_status, task_logs, progressPercentage)
+
+    lost = [member['taskId'] for member in members if not ensure_lease(member['taskId'])]
+    if lost:
+        # The run was prepared for hosts another agent now owns; the remaining members go back
+        # to the backlog and are prepared again without them
+        for member in members:
+            get_task_index().release(member['taskId'])
+            if member['taskId'] not in lost:
+                release_lease(member['taskId'])
+        return None
+
+    add_gauge("agent_tasks_in_flight", 1)
+    progress = None
+    try:
+        progress = ProgressReporter(taskId, post_member_events,
+                                    total_hosts=get_inventory(job['inventory_text']).host_count,
+                                    interval=float(app_context.config.get("progress_interval", 10)))
+        logger.info("Running playbook", extra={'task_id': taskId})
+        for member in members:
+            get_task_store().set_state(member['taskId'], RUNNING)
+        progress.start()
+        started = time.monotonic()
+        job['resdict'] = run_ansible(job['task_data'], progress, job['result_file_path'])
+        get_task_scheduler().estimator.record(job['playbook'], time.monotonic() - started)
+        logger.info("Playbook finished", extra={'task_id': taskId})
+        for member in members:
+            get_task_store().save_result(member['taskId'], 'COMPLETED', member_result(job, member),
+                                         member_logs(job, member))
+        return job
+    except Exception as e:
+        logger.error("Error executing task", extra={'task_id': taskId, 'error': str(e)})
+        for member in members:
+            finish_task(member['taskId'], 'FAILED', str(e), str(e))
+        return None
+    finally:
+        if progress is not None:
+            progress.stop()
+        add_gauge("agent_tasks_in_flight", -1)
+
+
+def report_job(job):
+    task = job['task']
+    for member in job['members']:
+        memberId = member['taskId']
+        try:
+            if ensure_lease(memberId):
+                logger.info("Posting result", extra={'task_id': memberId})
+                if post_result(memberId, member_result(job, member), 'COMPLETED', member_logs(job, member)) is not None:
+                    get_task_store().set_state(memberId, REPORTED)
+                    release_lease(memberId)
+                else:
+                    logger.warning("Result not accepted, will re-post on the next cycle", extra={'task_id': memberId})
+        except Exception as e:
+            logger.error("Error reporting task", extra={'task_id': memberId, 'error': str(e)})
+        get_task_index().complete(memberId)
+
+    get_task_index().remember_result(job['content_key'], {'final_res': job['resdict']["final_res"],
+                                                          'logs': job['resdict']["dockerlogs"].get("stdout", "")})
+    # Tasks with identical work that attached while this run was going take its result
+    for follower in get_task_index().detach(job['content_key']):
+        logger.info("Reusing result of identical run", extra={'task_id': follower['taskId'], 'run': job['taskId']})
+        finish_task(follower['taskId'], 'COMPLETED', member_result(job, follower), member_logs(job, follower))
+    logger.info("Task reported", extra={'task_id': job['taskId'], 'trigger': task['trigger'],
+                                         'tasks': len(job['members'])})
+
+
+def start_task_profile(taskNodes):
+    # Opt-in: profile_task_ids globs always match, profile_sample_rate samples the rest
+    sample_rate = float(app_context.config.get("profile_sample_rate", 0))
+    patterns = app_context.config.get("profile_task_ids")
+    if not sample_rate and not patterns:
+        return None
+    task_ids = [taskNode['taskId'] for taskNode in taskNodes]
+    if not should_profile(task_ids, sample_rate, patterns):
+        return None
+    logger.info("Profiling task", extra={'task_ids': task_ids})
+    return TaskProfiler(task_ids[0], top=int(app_context.config.get("profile_top", 10)),
+                        trace_frames=int(app_context.config.get("profile_trace_frames", 1)))
+
+
+def finish_task_profile(profiler, task_ids):
+    # Write the profile next to the task files and add its summary to each task's log
+    summary = profiler.finish(tasks_dir)
+    if summary is None:
+        return
+    message = format_profile_summary(summary)
+    logger.info("Task profile", extra={'task_id': profiler.task_id, 'stages': summary['stages'],
+                                       'traced_peak_mb': summary['traced_peak_mb']})
+    for taskId in task_ids:
+        # Only tasks with a stored final status get it; others went back to the backlog or belong
+        # to another agent now
+        status = get_task_store().get_status(taskId)
+        if status is None:
+            continue
+        try:
+            post_task_event(taskId, status, message, 100)
+        except Exception as e:
+            logger.warning("Failed to post task profile", extra={'task_id': taskId, 'error': str(e)})
+
+
+def run_profiled_stage(name, func, item, profiler, task_ids, last=False):
+    # The profile is finished once the task leaves the pipeline, whether it completed or failed
+    result = None
+    try:
+        with profiler.stage(name):
+            result = func(item)
+        return result
+    finally:
+        if result is None or last:
+            finish_task_profile(profiler, task_ids)
+
+
+def profiled_prepare(batch):
+    profiler = start_task_profile(batch['taskNodes'])
+    if profiler is None:
+        return prepare_task(batch)
+    job = run_profiled_stage("prepare", prepare_task, batch, profiler,
+                             [taskNode['taskId'] for taskNode in batch['taskNodes']])
+    if job is not None:
+        job['profiler'] = profiler
+    return job
+
+
+def profiled_execute(job):
+    if job.get('profiler') is None:
+        return execute_job(job)
+    return run_profiled_stage("execute", execute_job, job, job['profiler'],
+                              [member['taskId'] for member in job['members']])
+
+
+def profiled_report(job):
+    if job.get('profiler') is None:
+        return report_job(job)
+    return run_profiled_stage("report", report_job, job, job['profiler'],
+                              [member['taskId'] for member in job['members']], last=True)
+
+
+# Names the agent writes as artifacts; state kept alongside them (task store, leases,
+# runtime estimates) must never match
+TASK_ARTIFACT_PATTERNS = ["task_*.json", "task_result_*.json", "inventory_*", "profile_*"]
+
+
+def evict_artifacts():
+    # Keep task files, response dumps, kept runner workspaces and event logs within size/age bounds
+    global last_eviction
+    now = time.monotonic()
+    if last_eviction and now - last_eviction < float(app_context.config.get("artifact_evict_interval", 300)):
+        return
+    last_eviction = now
+    max_bytes = int(app_context.config.get("artifact_max_bytes", 1024 ** 3))
+    max_age = float(app_context.config.get("artifact_max_age", 7 * 86400))
+    roots = [
+        (tasks_dir, TASK_ARTIFACT_PATTERNS),
+        (app_context.config.get("debug_dump_dir") or os.path.join(tasks_dir, 'responses'), ["*.json"]),
+        (app_context.config.get("runner_workspace_root") or os.path.join(os.getcwd(), '.ansible-runner'), ["run_*"]),
+        (app_context.config.get("event_log_dir"), ["*.jsonl"]),
+    ]
+    for root, patterns in roots:
+        if root:
+            ArtifactStore(root, max_bytes=max_bytes, max_age=max_age, patterns=patterns).evict()
+
+
+def get_execute_workers():
+    return int(app_context.config.get("max_concurrent_tasks") or os.cpu_count() or 1)
+
+
+def task_group_done(batch, discarded):
+    # Tasks dropped at shutdown stay in the task store and are resumed on the next start
+    taskNodes = batch['taskNodes']
+    release_task_type_slot(taskNodes[0].get('taskSubType'))
+    get_task_scheduler().forget([taskNode['taskId'] for taskNode in taskNodes])
+    # Tasks still attached to a run that ended without a result go back to the backlog
+    for follower in get_task_index().detach(batch.get('content_key')):
+        get_task_index().release(follower['taskId'])
+    if discarded:
+        for taskNode in taskNodes:
+            logger.info("Task not started before shutdown", extra={'task_id': taskNode['taskId']})
+            get_task_index().release(taskNode['taskId'])
+            release_lease(taskNode['taskId'])
+    pipeline_event.set()
+
+
+def get_task_pipeline():
+    global task_pipeline
+    if task_pipeline is None:
+        # Preparing the next task and reporting the previous one overlap with running playbooks
+        task_pipeline = TaskPipeline(profiled_prepare, profiled_execute, profiled_report,
+                                     execute_workers=get_execute_workers(),
+                                     prepare_workers=int(app_context.config.get("prepare_workers", 1)),
+                                     report_workers=int(app_context.config.get("report_workers", 1)),
+                                     queue_size=int(app_context.config.get("pipeline_queue_size", 4)),
+                                     shutdown_event=shutdown_event,
+                                     on_done=task_group_done).start()
+    return task_pipeline
+
+
+def stop_task_pipeline():
+    # Wait for running tasks to finish and be reported
+    global task_pipeline
+    if task_pipeline is not None:
+        task_pipeline.close()
+        task_pipeline = None
+
+
+def free_capacity():
+    # Enough admitted work to keep every executor busy with the next run already prepared
+    capacity = get_execute_workers() + int(app_context.config.get("prepare_workers", 1))
+    return capacity - get_task_pipeline().pending()
+
+
+def admit_tasks(taskNodes):
+    # Start as many waiting tasks as the pipeline has room for. The rest stay fetched in the
+    # task store and are admitted by a later cycle. Returns how many tasks are still waiting.
+    waiting = [taskNode for taskNode in resume_tasks(taskNodes)
+               if not get_task_index().is_in_flight(taskNode['taskId'])]
+    if not waiting:
+        return 0
+    decoded = decode_tasks(waiting)
+    free = free_capacity()
+    admitted = []
+    deferred = 0
+    for group in schedule_tasks(coalesce_tasks(waiting, decoded), decoded):
+        if len(admitted) >= free or not acquire_task_type_slot(group[0].get('taskSubType')):
+            deferred += len(group)
+            continue
+        claimed = claim_tasks(group)
+        if claimed:
+            admitted.append(claimed)
+        else:
+            release_task_type_slot(group[0].get('taskSubType'))
+    prefetch_edr_tokens([taskNode for group in admitted for taskNode in group], decoded)
+    pipeline = get_task_pipeline()
+    for group in admitted:
+        pipeline.submit({'taskNodes': group,
+                         'decoded': {taskNode['taskId']: decoded[taskNode['taskId']] for taskNode in group}})
+    if deferred:
+        logger.debug("Tasks waiting for capacity", extra={'tasks': deferred})
+    return deferred
+
+
+def fetch_tasks():
     # url =  "https://kimaya.appdb.io//staticfs/test-task.json"
     url = base_url + "/getTasks"
     response = execute_get_request(url, app_context)
     if response:
         if response.get("success"):
             tasks = response.get("result", {}).get("tasks", [])
-            for taskNodes in tasks:
-                for taskNode in taskNodes:
-                    try:
-                        # print(taskNode['taskInput'])
-                        taskRaw = base64.b64decode(taskNode['taskInput'])
-                        print("\n\n\n\n")
-                        print(taskRaw)
-                        task = json.loads(taskRaw)
-                        taskId = taskNode['taskId']
-                        taskName = taskNode['taskName']
-                        taskType = taskNode['taskType']
-                        taskSubType = taskNode['taskSubType']
-                        taskStatus = taskNode['taskStatus']
-                        task['taskId'] = taskId
-
-                        task['template'] = base64.b64decode(task['template']).decode('utf-8')
-                        task['inventory'] = base64.b64decode(task['inventory']).decode('utf-8')
-                        task['eargs'] = ""
-                        # remove hard coded eargs
-
-                        # task['trigger'] = taskNode['taskInput']['trigger']
-                        # task['taskid'] = taskNode['taskInput']['taskid']
-                        # task['eargs'] = taskNode['taskInput']['eargs']
-
-                        write_to_file(task['inventory'], inventory_file)
-                        print(f"Created Inv. File {inventory_file} \n\n")
-
-                        print(f"Template {task['template']}\n\n")
-
-                        task_data = prepare_json(taskType, taskSubType, task['template'], inventory_file_key,
-                                                 task['trigger'], task['taskId'], task['eargs'])
-
-                        with open(task_file_path, 'w') as f:
-                            json.dump(task_data, f, indent=2)
-
-                        print(f"Created Task File {task_file_path}")
-
-                        # post_task_event(taskId,"IN_PROGRESS",task_data,20)
-
-                        print("Deploying Docker")
-                        resdict = run_ansible(task_file_path, result_file_path, task['trigger'], task['eargs'])
-                        print("Docker Job Finished")
-                        post_task_event(taskId, "IN_PROGRESS", resdict["dockerlogs"], 75)
-
-                        print("Posting Result")
-                        dockerlogs = resdict["dockerlogs"]
-                        final_res = resdict["final_res"]
-                        post_result(task['taskId'], final_res, 'COMPLETED', dockerlogs)
-
-                        print(
-                            f"Template: {task['template']}, Inventory: {task['inventory']}, Trigger: {task['trigger']}")
-                    except Exception as e:
-                        print(f"Error processing task: {e}")
-                        post_result(task['taskid'], {e}, 'FAILED', {e})
-
+            return [taskNode for nodes in tasks for taskNode in nodes]
         else:
-            print("Failed to retrieve tasks. Check the API response for more details.")
+            logger.error("Failed to retrieve tasks. Check the API response for more details.")
     else:
-        print("Failed to connect to the API. Check the API endpoint and credentials.")
+        logger.error("Failed to connect to the API. Check the API endpoint and credentials.")
+    return None
+
+
+def poll_tasks():
+    # One poll cycle; returns (tasks fetched, tasks still waiting for capacity)
+    # Create directories if they do not exist
+    if not os.path.exists(tasks_dir):
+        os.makedirs(tasks_dir)
+    evict_artifacts()
+    taskNodes = fetch_tasks() or []
+    return len(taskNodes), admit_tasks(taskNodes)
+
+
+def execute_tasks():
+    # Single run: admit the fetched tasks as capacity frees up, then wait for all of them.
+    # Tasks handed back while others run (e.g. attached to a run that failed) are admitted too.
+    fetched, waiting = poll_tasks()
+    poll_min = float(app_context.config.get("poll_min_interval", 2))
+    while (waiting or get_task_pipeline().pending()) and not shutdown_event.is_set():
+        pipeline_event.wait(poll_min)
+        pipeline_event.clear()
+        waiting = admit_tasks([])
+    stop_task_pipeline()
+    return fetched
+
+
+def run_agent():
+    # Resident loop: keep polling while tasks run, admitting new work as capacity frees up.
+    # Poll fast while tasks keep arriving, back off while the queue is empty.
+    poll_min = float(app_context.config.get("poll_min_interval", 2))
+    poll_max = float(app_context.config.get("poll_max_interval", 60))
+    backoff_factor = float(app_context.config.get("poll_backoff_factor", 2))
+
+    def request_shutdown(signum, frame):
+        logger.info("Received signal, finishing in-flight tasks before exit", extra={'signal': signum})
+        shutdown_event.set()
+        pipeline_event.set()
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+    interval = poll_min
+    while not shutdown_event.is_set():
+        pipeline_event.clear()
+        if free_capacity() <= 0:
+            # Nothing fetched now could start; wait for a running task to finish
+            pipeline_event.wait(poll_max)
+            continue
+        try:
+            fetched, waiting = poll_tasks()
+        except Exception:
+            logger.exception("Poll cycle failed")
+            fetched, waiting = 0, 0
+
+        if fetched or waiting:
+            interval = poll_min
+        # A finished task frees capacity, so its waiting work starts without the full wait
+        pipeline_event.wait(interval)
+        if not (fetched or waiting):
+            interval = min(interval * backoff_factor, poll_max)
+    stop_task_pipeline()
+    logger.info("Agent stopped")
 
 
 if __name__ == "__main__":
@@ -252,4 +887,31 @@ if __name__ == "__main__":
     config_path = "agent.conf"  # sys.argv[1]
     # Load configuration
     app_context = load_config(config_path)
-    execute_tasks()
+    configure_logging(level=app_context.config.get("log_level", "INFO"),
+                      log_file=app_context.config.get("log_file"),
+                      dump_dir=app_context.config.get("debug_dump_dir") or os.path.join(tasks_dir, 'responses'),
+                      dump_rate=float(app_context.config.get("debug_dump_rate", 1.0)),
+                      dump_max_bytes=int(app_context.config.get("debug_dump_max_bytes", 1048576)))
+    configure_inventory_cache(int(app_context.config.get("inventory_cache_size", 256)))
+    if app_context.config.get("metrics_port"):
+        start_metrics_server(int(app_context.config.get("metrics_port")))
+    if app_context.config.get("metrics_file"):
+        start_metrics_file_writer(app_context.config.get("metrics_file"),
+                                  float(app_context.config.get("metrics_interval", 15)))
+    if "--profile-imports" in sys.argv:
+        # Report what each lazily loaded subsystem would add to startup, then exit
+        for module_name in (ANSI_UTILS_MODULE, EDR_UTILS_MODULE):
+            try:
+                lazy_import(module_name)
+            except ImportError as e:
+                print(f"Could not import {module_name}: {e}")
+        print(format_import_profile())
+        sys.exit(0)
+    if "--daemon" in sys.argv or app_context.config.get("daemon"):
+        run_agent()
+    else:
+        execute_tasks()
+    if lease_manager is not None:
+        lease_manager.stop()
+    flush_artifacts()
+    stop_logging()
@@ -0,0 +1,72 @@
+import base64
+import gzip
+import json
+
+DEFAULT_LIMITS = {
+    'result_max_stdout': 4096,
+    'result_include_details': False,
+    'log_max_bytes': 262144,
+    'log_compress_threshold': 16384,
+}
+
+
+def get_limits(config):
+    return {key: config.get(key, default) for key, default in DEFAULT_LIMITS.items()}
+
+
+def truncate_text(text, max_chars):
+    # Keep the tail, which is where ansible reports failures and the play recap
+    if text is None:
+        return ""
+    if not isinstance(text, str):
+        text = json.dumps(text, separators=(',', ':'), default=str)
+    if len(text) <= max_chars:
+        return text
+    return f"...[{len(text) - max_chars} chars truncated]...\n" + text[-max_chars:]
+
+
+def encode_log(text, limits):
+    # Small logs go as plain text; larger ones are gzip-compressed and base64-encoded
+    text = truncate_text(text, int(limits['log_max_bytes']))
+    if len(text) < int(limits['log_compress_threshold']):
+        return text
+    compressed = base64.b64encode(gzip.compress(text.encode('utf-8'))).decode('ascii')
+    return {
+        'encoding': 'gzip+base64',
+        'size': len(text),
+        'data': compressed,
+    }
+
+
+def build_result_payload(task_result, limits):
+    # Compact per-host status rows; full per-host details only when explicitly enabled
+    if not isinstance(task_result, dict) or 'taskstatus' not in task_result:
+        return truncate_text(task_result, int(limits['result_max_stdout']))
+    max_stdout = int(limits['result_max_stdout'])
+    rows = [
+        {
+            'hostname': row['hostname'],
+            'code': row['code'],
+            'stdout': truncate_text(row['stdout'], max_stdout),
+            'status': row['status'],
+        }
+        for row in task_result['taskstatus']
+    ]
+    payload = {'taskstatus': rows}
+    if limits['result_include_details']:
+        payload['data_task_res'] = task_result.get('data_task_res')
+    return payload
+
+
+def build_log_payload(task_logs, limits):
+    # Runner results are reduced to their (already tail-capped) stdout before encoding
+    if isinstance(task_logs, dict) and 'output' in task_logs:
+        task_logs = task_logs.get('stdout', '')
+    return encode_log(task_logs, limits)
+
+
+def build_status_message(task_logs, limits):
+    if isinstance(task_logs, str):
+        return truncate_text(task_logs, int(limits['log_compress_threshold']))
+    return truncate_text(json.dumps(task_logs, separators=(',', ':'), default=str),
+                         int(limits['log_compress_threshold']))
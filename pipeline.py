@@ -0,0 +1,107 @@
+import logging
+import queue
+import threading
+
+from metrics import set_gauge
+
+logger = logging.getLogger(__name__)
+
+STOP = object()
+
+
+class TaskPipeline:
+    # Runs items through prepare -> execute -> report stages connected by bounded queues.
+    # A full queue blocks the stage feeding it, so a slow portal or a busy executor
+    # applies backpressure instead of letting prepared work pile up in memory.
+    # A stage returning None drops the item; the stage is expected to have reported the failure.
+    # The caller bounds how much it submits (see pending()), so the input queue is unbounded.
+    # Once `shutdown_event` is set, items that have not started prepare or execute are
+    # discarded; results already produced are still reported. `on_done(item, discarded)` is
+    # called with the submitted item whenever it leaves the pipeline.
+
+    def __init__(self, prepare, execute, report, execute_workers=1, prepare_workers=1, report_workers=1,
+                 queue_size=4, shutdown_event=None, on_done=None):
+        self.stages = [
+            ("prepare", prepare, prepare_workers),
+            ("execute", execute, execute_workers),
+            ("report", report, report_workers),
+        ]
+        self.queue_size = queue_size
+        self.shutdown_event = shutdown_event
+        self.on_done = on_done
+        self.lock = threading.Lock()
+        self.in_pipeline = 0
+        self.queues = None
+        self.threads = []
+
+    def _finish(self, origin, discarded):
+        # The item counts as pending until its callback has run
+        if self.on_done is not None:
+            try:
+                self.on_done(origin, discarded)
+            except Exception:
+                logger.exception("Pipeline completion callback failed")
+        with self.lock:
+            self.in_pipeline -= 1
+
+    def _worker(self, name, func, in_queue, out_queue):
+        while True:
+            entry = in_queue.get()
+            set_gauge("agent_pipeline_queue_depth", in_queue.qsize(), {'stage': name})
+            if entry is STOP:
+                return
+            origin, item = entry
+            if out_queue is not None and self.shutdown_event is not None and self.shutdown_event.is_set():
+                self._finish(origin, True)
+                continue
+            try:
+                result = func(item)
+            except Exception:
+                logger.exception("Pipeline stage failed", extra={'stage': name})
+                result = None
+            if result is not None and out_queue is not None:
+                out_queue.put((origin, result))
+            else:
+                self._finish(origin, False)
+
+    def start(self):
+        self.queues = [queue.Queue()] + [queue.Queue(maxsize=self.queue_size) for _ in self.stages[1:]]
+        for index, (name, func, workers) in enumerate(self.stages):
+            out_queue = self.queues[index + 1] if index + 1 < len(self.queues) else None
+            stage_threads = [
+                threading.Thread(target=self._worker, args=(name, func, self.queues[index], out_queue),
+                                 name=f"{name}-{i}", daemon=True)
+                for i in range(workers)
+            ]
+            for thread in stage_threads:
+                thread.start()
+            self.threads.append(stage_threads)
+        return self
+
+    def submit(self, item):
+        with self.lock:
+            self.in_pipeline += 1
+        self.queues[0].put((item, item))
+
+    def pending(self):
+        # Submitted items that have not left the pipeline yet
+        with self.lock:
+            return self.in_pipeline
+
+    def close(self):
+        # Drain stage by stage so every queued item reaches the end of the pipeline
+        for index, stage_threads in enumerate(self.threads):
+            for _ in stage_threads:
+                self.queues[index].put(STOP)
+            for thread in stage_threads:
+                thread.join()
+        self.threads = []
+
+    def run(self, items):
+        self.start()
+        count = 0
+        for item in items:
+            self.submit(item)
+            count += 1
+        self.close()
+        return count
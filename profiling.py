@@ -0,0 +1,159 @@
+import cProfile
+import fnmatch
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# tracemalloc is process-wide; it runs while at least one profiled task is active
+tracing_lock = threading.Lock()
+tracing_users = 0
+tracing_started = False
+
+
+def should_profile(task_ids, sample_rate=0.0, task_patterns=None):
+    # Profile when any taskId matches a configured glob, otherwise for a random sample
+    for task_id in task_ids:
+        if any(fnmatch.fnmatchcase(f"{task_id}", pattern) for pattern in task_patterns or []):
+            return True
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def _start_tracing(frames):
+    global tracing_users, tracing_started
+    with tracing_lock:
+        if tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            tracing_started = True
+        tracing_users += 1
+
+
+def _stop_tracing():
+    global tracing_users, tracing_started
+    with tracing_lock:
+        tracing_users -= 1
+        if tracing_users == 0 and tracing_started:
+            tracemalloc.stop()
+            tracing_started = False
+
+
+class TaskProfiler:
+    # CPU (cProfile) and memory (tracemalloc) capture for one task across the prepare,
+    # execute and report stages. Each stage runs on its own pipeline thread, so every stage
+    # gets its own cProfile.Profile and the stats are merged when the task finishes.
+    # Allocation diffs are process-wide and include other tasks running at the same time.
+
+    def __init__(self, task_id, top=10, trace_frames=1):
+        self.task_id = task_id
+        self.top = top
+        self.profiles = []
+        self.stage_seconds = {}
+        self.started = time.time()
+        _start_tracing(trace_frames)
+        self.baseline = tracemalloc.take_snapshot()
+        self.finished = False
+
+    @contextmanager
+    def stage(self, name):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one active profiler at a time; the stage still gets timed
+            profile = None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] = round(time.perf_counter() - start, 4)
+            if profile is not None:
+                profile.disable()
+                self.profiles.append(profile)
+
+    def _stats(self):
+        stats = None
+        for profile in self.profiles:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            except TypeError:
+                # A stage that made no calls has nothing to merge
+                continue
+        return stats
+
+    def hotspots(self, stats):
+        if stats is None:
+            return []
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.top]
+        return [{
+            'function': f"{func} ({os.path.basename(filename)}:{line})",
+            'calls': calls,
+            'total_s': round(total, 4),
+            'cumulative_s': round(cumulative, 4),
+        } for (filename, line, func), (_, calls, total, cumulative, _) in rows]
+
+    def allocations(self, snapshot):
+        rows = snapshot.compare_to(self.baseline, 'lineno')[:self.top]
+        return [{
+            'location': f"{os.path.basename(row.traceback[0].filename)}:{row.traceback[0].lineno}",
+            'size_kb': round(row.size_diff / 1024.0, 1),
+            'count': row.count_diff,
+        } for row in rows]
+
+    def finish(self, directory=None):
+        # Stop capturing and return the summary; the full stats are written to `directory`
+        if self.finished:
+            return None
+        self.finished = True
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            _stop_tracing()
+        stats = self._stats()
+        summary = {
+            'taskId': f"{self.task_id}",
+            'stages': self.stage_seconds,
+            'wall_s': round(time.time() - self.started, 4),
+            'traced_peak_mb': round(peak / 1024.0 / 1024.0, 2),
+            'hotspots': self.hotspots(stats),
+            'allocations': self.allocations(snapshot),
+        }
+        if directory:
+            self.write(directory, stats, summary)
+        return summary
+
+    def write(self, directory, stats, summary):
+        safe_id = re.sub(r"[^A-Za-z0-9_.-]", "_", f"{self.task_id}")
+        base = os.path.join(directory, f"profile_{safe_id}_{time.strftime('%Y%m%d_%H%M%S')}")
+        try:
+            if stats is not None:
+                # Loadable with pstats or snakeviz
+                stats.dump_stats(f"{base}.pstats")
+            with open(f"{base}.json", 'w') as f:
+                json.dump(summary, f, separators=(',', ':'))
+            logger.info("Wrote task profile", extra={'task_id': self.task_id, 'path': base})
+        except OSError as e:
+            logger.error("Error writing task profile", extra={'task_id': self.task_id, 'error': str(e)})
+
+
+def format_profile_summary(summary, top=5):
+    # Short text form for the task's status log
+    lines = [f"profile: wall {summary['wall_s']}s, traced peak {summary['traced_peak_mb']} MB, "
+             f"stages {summary['stages']}"]
+    lines.append("top cumulative:")
+    lines.extend(f"  {row['cumulative_s']}s {row['function']} x{row['calls']}" for row in summary['hotspots'][:top])
+    lines.append("top allocations:")
+    lines.extend(f"  {row['size_kb']} KB {row['location']} ({row['count']} blocks)"
+                 for row in summary['allocations'][:top])
+    return "\n".join(lines)
@@ -0,0 +1,152 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+HOST_DONE_EVENTS = ('runner_on_failed', 'runner_on_unreachable')
+TASK_RESULT_EVENTS = ('runner_on_ok', 'runner_on_failed', 'runner_on_skipped', 'runner_on_unreachable')
+
+
+class PlayProgress:
+    # Counters for one runner invocation: the whole play, or one shard of a sharded run
+
+    def __init__(self, total_hosts=0):
+        self.total_hosts = total_hosts
+        self.hosts_seen = set()
+        self.hosts_done = set()
+        self.tasks_started = 0
+        self.tasks_completed = 0
+        self.play_done = False
+
+    def record(self, event):
+        event_type = event.get('event')
+        host = event.get('event_data', {}).get('host')
+        if event_type == 'playbook_on_task_start':
+            self.tasks_started += 1
+        elif event_type in TASK_RESULT_EVENTS:
+            self.tasks_completed += 1
+        elif event_type == 'playbook_on_stats':
+            self.hosts_done.update(self.hosts_seen)
+            self.play_done = True
+        if host:
+            self.hosts_seen.add(host)
+            if event_type in HOST_DONE_EVENTS:
+                self.hosts_done.add(host)
+
+    @property
+    def host_total(self):
+        return self.total_hosts or len(self.hosts_seen)
+
+    def fraction(self):
+        # The play's task count is unknown up front, so results are measured against every task
+        # started so far plus one still to come
+        if self.play_done:
+            return 1.0
+        if not self.host_total:
+            return 0.0
+        return min(self.tasks_completed / ((self.tasks_started + 1) * self.host_total), 1.0)
+
+
+class ShardProgress:
+    # Event and status handlers for one shard's runner, feeding that shard's counters
+
+    def __init__(self, reporter, play):
+        self.reporter = reporter
+        self.play = play
+
+    def event_handler(self, event):
+        with self.reporter.lock:
+            self.play.record(event)
+            self.reporter.dirty = True
+
+    def status_handler(self, status, runner_config=None):
+        self.reporter.status_handler(status, runner_config)
+
+
+class ProgressReporter:
+    # Collects progress from ansible-runner event/status handlers and posts it
+    # from a background thread at most once every `interval` seconds.
+    # A sharded run gets one PlayProgress per shard (see shards()); the task's progress
+    # combines them weighted by host count, and the play is done once every shard is.
+
+    def __init__(self, task_id, post_event, total_hosts=0, interval=10, start_percent=20, end_percent=90):
+        self.task_id = task_id
+        self.post_event = post_event
+        self.interval = interval
+        self.start_percent = start_percent
+        self.end_percent = end_percent
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.dirty = False
+        self.status = 'starting'
+        self.plays = [PlayProgress(total_hosts)]
+        self.last_percent = start_percent
+
+    def shards(self, host_counts):
+        # Handlers for each shard of a sharded run, replacing the single whole-play counters
+        with self.lock:
+            self.plays = [PlayProgress(count) for count in host_counts]
+            self.dirty = True
+            return [ShardProgress(self, play) for play in self.plays]
+
+    def event_handler(self, event):
+        with self.lock:
+            self.plays[0].record(event)
+            self.dirty = True
+
+    def status_handler(self, status, runner_config=None):
+        with self.lock:
+            self.status = status.get('status', self.status)
+            self.dirty = True
+
+    def percent(self):
+        # The reported value never goes backwards
+        weights = [play.host_total or 1 for play in self.plays]
+        fraction = sum(play.fraction() * weight for play, weight in zip(self.plays, weights)) / sum(weights)
+        percent = int(self.start_percent + (self.end_percent - self.start_percent) * fraction)
+        self.last_percent = max(self.last_percent, percent)
+        return self.last_percent
+
+    def snapshot(self):
+        with self.lock:
+            self.dirty = False
+            message = {
+                'status': self.status,
+                'hosts_done': sum(len(play.hosts_done) for play in self.plays),
+                'hosts_total': sum(play.host_total for play in self.plays),
+                'tasks_started': sum(play.tasks_started for play in self.plays),
+                'tasks_completed': sum(play.tasks_completed for play in self.plays),
+            }
+            if len(self.plays) > 1:
+                message['shards'] = [{
+                    'hosts_done': len(play.hosts_done),
+                    'hosts_total': play.host_total,
+                    'done': play.play_done,
+                    'percent': int(100 * play.fraction()),
+                } for play in self.plays]
+            return message, self.percent()
+
+    def flush(self, force=False):
+        if not (self.dirty or force):
+            return
+        message, percent = self.snapshot()
+        try:
+            self.post_event(self.task_id, "IN_PROGRESS", message, percent)
+        except Exception as e:
+            logger.warning("Failed to post progress", extra={'task_id': self.task_id, 'error': str(e)})
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.flush()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=f"progress-{self.task_id}", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush(force=True)
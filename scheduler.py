@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Security installs go ahead of routine patching unless task_priorities says otherwise
+DEFAULT_PRIORITIES = {
+    "INSTALL_LINUX_EDR": 100,
+    "INSTALL_MAC_EDR": 100,
+    "WIN_EDR_INSTALL": 100,
+    "LINUX_PATCH": 0,
+    "MAC_PATCH": 0,
+    "WINDOWS_PATCH": 0,
+}
+
+
+def parse_deadline(value):
+    # Deadlines arrive as epoch seconds or ISO 8601 strings; anything else is ignored
+    if value in (None, ""):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        logger.warning("Ignoring unparseable deadline", extra={'deadline': value})
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+class RuntimeEstimator:
+    # Exponentially weighted moving average of run durations per playbook, optionally
+    # persisted to a JSON file so estimates survive restarts.
+
+    def __init__(self, alpha=0.3, default=300.0, persist_path=None):
+        self.alpha = alpha
+        self.default = default
+        self.persist_path = persist_path
+        self.lock = threading.Lock()
+        self.estimates = {}
+        if persist_path:
+            self._load()
+
+    def estimate(self, playbook):
+        with self.lock:
+            return self.estimates.get(playbook, self.default)
+
+    def record(self, playbook, seconds):
+        with self.lock:
+            previous = self.estimates.get(playbook)
+            self.estimates[playbook] = seconds if previous is None else \
+                self.alpha * seconds + (1 - self.alpha) * previous
+            if self.persist_path:
+                self._save()
+
+    def _load(self):
+        try:
+            with open(self.persist_path, 'r') as f:
+                self.estimates = {key: float(value) for key, value in json.load(f).items()}
+        except (OSError, ValueError):
+            return
+
+    def _save(self):
+        tmp_path = f"{self.persist_path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.estimates, f, separators=(',', ':'))
+            os.replace(tmp_path, self.persist_path)
+        except OSError as e:
+            logger.error("Error persisting runtime estimates", extra={'path': self.persist_path, 'error': str(e)})
+
+
+class TaskScheduler:
+    # Orders a fetched batch before it enters the pipeline. Work whose deadline is within
+    # `deadline_horizon` seconds of its estimated finish runs first, least slack first.
+    # Everything else runs by priority, raised by `aging_rate` points per minute waited so
+    # low-priority work is not starved, then shortest estimated runtime first.
+
+    def __init__(self, estimator, priorities=None, default_priority=0, aging_rate=1.0, deadline_horizon=900):
+        self.estimator = estimator
+        self.priorities = dict(DEFAULT_PRIORITIES)
+        self.priorities.update({key.upper(): value for key, value in (priorities or {}).items()})
+        self.default_priority = default_priority
+        self.aging_rate = aging_rate
+        self.deadline_horizon = deadline_horizon
+        self.lock = threading.Lock()
+        self.first_seen = {}
+
+    def priority(self, task_sub_type):
+        return float(self.priorities.get((task_sub_type or "").upper(), self.default_priority))
+
+    def sort_key(self, entry, now):
+        estimate = self.estimator.estimate(entry['playbook'])
+        waited = now - min(self.first_seen[task_id] for task_id in entry['task_ids'])
+        deadline = entry.get('deadline')
+        if deadline is not None:
+            slack = deadline - now - estimate
+            if slack <= self.deadline_horizon:
+                return (0, slack, 0.0, entry['index'])
+        effective = self.priority(entry['task_sub_type']) + self.aging_rate * waited / 60.0
+        return (1, -effective, estimate, entry['index'])
+
+    def order(self, entries):
+        # entries: dicts with 'group', 'task_ids', 'task_sub_type', 'playbook' and optional 'deadline'.
+        # A task keeps its first-seen time while it waits across cycles, until forget() is called.
+        now = time.time()
+        with self.lock:
+            for index, entry in enumerate(entries):
+                entry['index'] = index
+                for task_id in entry['task_ids']:
+                    self.first_seen.setdefault(task_id, now)
+            ordered = sorted(entries, key=lambda entry: self.sort_key(entry, now))
+        return [entry['group'] for entry in ordered]
+
+    def forget(self, task_ids):
+        # The tasks finished or moved to another agent
+        with self.lock:
+            for task_id in task_ids:
+                self.first_seen.pop(task_id, None)
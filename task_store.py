@@ -0,0 +1,96 @@
+import json
+import sqlite3
+import threading
+import time
+
+FETCHED = "fetched"
+PREPARED = "prepared"
+RUNNING = "running"
+EXECUTED = "executed"
+REPORTED = "reported"
+
+# States a task can be in when the agent stopped before its result was stored
+INTERRUPTED_STATES = (FETCHED, PREPARED, RUNNING)
+
+
+class TaskStore:
+    # Durable record of each task's progress through the agent, kept in SQLite (WAL mode)
+    # so a restarted agent can resume from the last completed stage.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                node TEXT NOT NULL,
+                state TEXT NOT NULL,
+                status TEXT,
+                result TEXT,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+    def get_state(self, task_id):
+        with self.lock:
+            row = self.conn.execute("SELECT state FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return row[0] if row else None
+
+    def get_status(self, task_id):
+        with self.lock:
+            row = self.conn.execute("SELECT status FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return row[0] if row else None
+
+    def record_fetched(self, task_node):
+        # New tasks start as fetched; tasks already known keep their current state
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO tasks (task_id, node, state, updated_at) VALUES (?, ?, ?, ?)",
+                (task_node['taskId'], json.dumps(task_node), FETCHED, time.time()))
+
+    def set_state(self, task_id, state):
+        with self.lock:
+            self.conn.execute("UPDATE tasks SET state = ?, updated_at = ? WHERE task_id = ?",
+                              (state, time.time(), task_id))
+
+    def save_result(self, task_id, status, result, logs):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE tasks SET state = ?, status = ?, result = ?, updated_at = ? WHERE task_id = ?",
+                (EXECUTED, status, json.dumps({'result': result, 'logs': logs}, default=str), time.time(),
+                 task_id))
+
+    def unreported_results(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT task_id, status, result FROM tasks WHERE state = ? ORDER BY updated_at",
+                (EXECUTED,)).fetchall()
+        for task_id, status, result in rows:
+            data = json.loads(result)
+            yield task_id, status, data['result'], data['logs']
+
+    def interrupted_nodes(self):
+        placeholders = ",".join("?" for _ in INTERRUPTED_STATES)
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT node FROM tasks WHERE state IN ({placeholders}) ORDER BY updated_at",
+                INTERRUPTED_STATES).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def forget(self, task_id):
+        # Drop a task that another agent is handling so it is not resumed or re-posted here
+        with self.lock:
+            self.conn.execute("DELETE FROM tasks WHERE task_id = ? AND state IN (?, ?, ?, ?)",
+                              (task_id,) + INTERRUPTED_STATES + (EXECUTED,))
+
+    def purge_reported(self, max_age):
+        with self.lock:
+            self.conn.execute("DELETE FROM tasks WHERE state = ? AND updated_at < ?",
+                              (REPORTED, time.time() - max_age))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
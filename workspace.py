@@ -0,0 +1,105 @@
+import fnmatch
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Workspaces of runs still in progress; eviction never removes them
+active_workspaces = set()
+active_workspaces_lock = threading.Lock()
+
+
+class ArtifactStore:
+    # Bounds a directory of task artifacts by total size and entry age, evicting oldest first.
+    # With `patterns` set only matching names are artifacts; anything else in the directory
+    # (e.g. the task store database) is neither counted nor removed.
+
+    def __init__(self, root, max_bytes=1024 ** 3, max_age=7 * 86400, patterns=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.patterns = patterns
+
+    def path(self, name):
+        os.makedirs(self.root, exist_ok=True)
+        return os.path.join(self.root, name)
+
+    def _entry_size(self, path):
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass
+        return total
+
+    def _remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def evict(self):
+        if not os.path.isdir(self.root):
+            return 0
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.root):
+            if self.patterns is not None and not any(fnmatch.fnmatchcase(name, p) for p in self.patterns):
+                continue
+            path = os.path.join(self.root, name)
+            with active_workspaces_lock:
+                if os.path.abspath(path) in active_workspaces:
+                    continue
+            try:
+                entries.append((os.path.getmtime(path), self._entry_size(path), path))
+            except OSError:
+                continue
+
+        removed = 0
+        total = 0
+        kept = []
+        for mtime, size, path in sorted(entries):
+            if now - mtime > self.max_age:
+                self._remove(path)
+                removed += 1
+            else:
+                kept.append((mtime, size, path))
+                total += size
+
+        for mtime, size, path in kept:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+            removed += 1
+        if removed:
+            logger.info("Evicted artifacts", extra={'root': self.root, 'removed': removed})
+        return removed
+
+
+@contextmanager
+def run_workspace(root, keep=False):
+    # Private directory for a single runner invocation, removed afterwards unless kept for debugging
+    path = os.path.join(root, f"run_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4()}")
+    os.makedirs(path)
+    with active_workspaces_lock:
+        active_workspaces.add(os.path.abspath(path))
+    try:
+        yield path
+    finally:
+        if not keep:
+            shutil.rmtree(path, ignore_errors=True)
+        with active_workspaces_lock:
+            active_workspaces.discard(os.path.abspath(path))